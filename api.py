@@ -0,0 +1,148 @@
+import gzip
+
+from flask import Blueprint, jsonify, request
+from sqlalchemy.orm import joinedload, load_only
+
+# Building blocks for the versioned JSON API. Each resource declares its
+# fields once, along with the columns and relationships they need, so a
+# request for ?fields=id,title,price only loads (and sends) those columns.
+# Collections accept ?ids=1,2,3 to fetch several resources in one query, and
+# responses are compressed with brotli (when installed) or gzip.
+
+MAX_BATCH_IDS = 100
+# Larger ids do not fit a 64-bit integer column
+MAX_ID = 2 ** 63 - 1
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Field:
+    def __init__(self, get, columns=(), relationship=None, related_columns=()):
+        self.get = get
+        self.columns = columns
+        self.relationship = relationship
+        self.related_columns = related_columns
+
+
+class FieldSet:
+    # fields: {name: Field}; `key_columns` are always loaded, e.g. the
+    # primary key and any columns a cursor is built from
+    def __init__(self, fields, default=None, key_columns=()):
+        self.fields = fields
+        self.default = list(default or fields)
+        self.key_columns = key_columns
+
+    def parse(self, value):
+        if not value:
+            return self.default
+        names = [name.strip() for name in value.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ApiError(f'Unknown fields: {", ".join(unknown)}. '
+                           f'Available: {", ".join(self.fields)}')
+        return names
+
+    def options(self, names):
+        # Loader options that fetch only what the selected fields need
+        columns = {column.key: column for column in self.key_columns}
+        related = {}
+        for name in names:
+            field = self.fields[name]
+            columns.update((column.key, column) for column in field.columns)
+            if field.relationship is not None:
+                related.setdefault(field.relationship, []).extend(field.related_columns)
+        options = [load_only(*columns.values())]
+        for relationship, related_columns in related.items():
+            options.append(joinedload(relationship).load_only(*related_columns))
+        return options
+
+    def dump(self, obj, names):
+        return {name: self.fields[name].get(obj) for name in names}
+
+
+def parse_ids(value, limit=MAX_BATCH_IDS):
+    ids = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if not (part.isascii() and part.isdigit()) or int(part) > MAX_ID:
+            raise ApiError(f'Invalid id: {part!r}')
+        if int(part) not in ids:
+            ids.append(int(part))
+    if not ids:
+        raise ApiError('ids must list at least one id')
+    if len(ids) > limit:
+        raise ApiError(f'At most {limit} ids can be fetched at once')
+    return ids
+
+
+def page_limit(default=20, maximum=100):
+    return min(max(request.args.get('limit', default, type=int), 1), maximum)
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def choose_encoding(accept_encoding, brotli_available):
+    if brotli_available and accept_encoding['br']:
+        return 'br'
+    if accept_encoding['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        # Brotli quality 0-11; 5 is much faster than the default and still
+        # smaller than gzip at its default level
+        return brotli_module().compress(data, quality=min(level, 11))
+    # mtime=0 keeps the output, and so weak ETags and caches, stable
+    return gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+
+def create_api_blueprint(name, url_prefix, db, min_size=1024, level=5):
+    api = Blueprint(name, __name__, url_prefix=url_prefix)
+    brotli_available = brotli_module() is not None
+
+    @api.errorhandler(ApiError)
+    def api_error(error):
+        return jsonify({'error': error.message}), error.status
+
+    @api.errorhandler(404)
+    def not_found(error):
+        # Only for aborts inside API views; unmatched URLs never reach the
+        # blueprint
+        return jsonify({'error': 'Not found'}), 404
+
+    @api.errorhandler(500)
+    def internal_error(error):
+        # As the app's handler: a failed flush leaves the session unusable
+        db.session.rollback()
+        return jsonify({'error': 'Internal server error'}), 500
+
+    @api.after_request
+    def compress_response(response):
+        response.vary.add('Accept-Encoding')
+        if (response.direct_passthrough or response.status_code < 200 or response.status_code >= 300
+                or 'Content-Encoding' in response.headers or response.content_length is None
+                or response.content_length < min_size):
+            return response
+        encoding = choose_encoding(request.accept_encodings, brotli_available)
+        if encoding is None:
+            return response
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    return api
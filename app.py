@@ -1,19 +1,71 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, abort, g, make_response, send_file
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+import click
+from sqlalchemy import func, or_, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import configure_mappers, joinedload, object_session
+from markupsafe import Markup
+import importlib
+import json
+import math
 import os
 import re
 from datetime import datetime
-import secrets
+
+from api import ApiError, Field, FieldSet, create_api_blueprint, page_limit, parse_ids
+from cache import create_cache
+from config import Config, load_secret_key
+from database import configure_sqlite, engine_options
+from facets import FacetCache
+from hashing import HasherBusy, PasswordHasher
+from instrumentation import Instrumentation
+from jobs import JobQueue
+from media import MediaStore, UploadError
+from migrations import Migrator
+from pagecache import CatalogVersion, FragmentCache, template_fingerprint
+from pagination import InvalidCursor, keyset_paginate
+from ratelimit import LoginThrottle, RateLimiter, SlidingWindow, create_store
+from realtime import conversation_channel, create_broker, format_event
+from search import SearchIndex
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_hex(16)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///marketplace.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
+app.config.from_object(Config)
+app.config['SECRET_KEY'] = load_secret_key(app.instance_path)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 
 db = SQLAlchemy(app)
+instrumentation = None
+with app.app_context():
+    configure_sqlite(db.engine, app.config)
+    if app.config['INSTRUMENTATION']:
+        instrumentation = Instrumentation(
+            app, db.engine,
+            slow_query_ms=app.config['SLOW_QUERY_MS'],
+            profile_threshold_ms=app.config['PROFILE_SLOW_REQUESTS_MS'],
+            profile_interval_ms=app.config['PROFILE_INTERVAL_MS'],
+            profile_dir=app.config['PROFILE_DIR']
+        )
+search_index = SearchIndex(db, app.config['SEARCH_BACKEND'])
+migrator = Migrator(db, search_index)
+cache = create_cache(app.config['CACHE_URL'])
+broker = create_broker(app.config['BROKER_URL'])
+media = MediaStore(
+    os.path.join(app.instance_path, app.config['UPLOAD_FOLDER']),
+    max_bytes=app.config['UPLOAD_MAX_BYTES']
+)
+password_hasher = PasswordHasher(
+    app.config['PASSWORD_HASH_METHOD'],
+    workers=app.config['PASSWORD_HASH_WORKERS'],
+    max_pending=app.config['PASSWORD_HASH_MAX_PENDING'] or None
+)
+ratelimit_store = create_store(app.config['RATELIMIT_URL'], log=app.logger.warning)
+rate_limiter = RateLimiter(ratelimit_store, enabled=app.config['RATELIMIT_ENABLED'])
+login_throttle = LoginThrottle(
+    ratelimit_store,
+    app.config['LOGIN_FAILURES_PER_IDENTIFIER'],
+    app.config['LOGIN_FAILURES_PER_IP'],
+    app.config['LOGIN_FAILURE_WINDOW']
+)
 
 # Database Models
 class User(db.Model):
@@ -34,23 +86,156 @@ class Product(db.Model):
     description = db.Column(db.Text, nullable=False)
     price = db.Column(db.Float, nullable=False)
     image_url = db.Column(db.String(200), nullable=True)
+    # SHA-256 of an uploaded image, see media.py
+    image_hash = db.Column(db.String(64), nullable=True)
     category = db.Column(db.String(50), nullable=False)
     condition = db.Column(db.String(20), nullable=False)
     seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_available = db.Column(db.Boolean, default=True)
+    
+    __table_args__ = (
+        # index(): newest available listings, optionally within a category
+        db.Index('ix_product_available_created', 'is_available', 'created_at', 'id'),
+        db.Index('ix_product_available_category_created', 'is_available', 'category', 'created_at', 'id'),
+        # Price-sorted listings and price ranges, see listing_page()
+        db.Index('ix_product_available_price', 'is_available', 'price', 'id'),
+        db.Index('ix_product_available_category_price', 'is_available', 'category', 'price', 'id'),
+        # Condition filters, newest first or by price
+        db.Index('ix_product_available_condition_created', 'is_available', 'condition', 'created_at', 'id'),
+        db.Index('ix_product_available_condition_price', 'is_available', 'condition', 'price', 'id'),
+        # my_products(): a seller's listings, newest first
+        db.Index('ix_product_seller_created', 'seller_id', 'created_at'),
+        # CatalogVersion: the latest product change
+        db.Index('ix_product_updated', 'updated_at'),
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    # The buyer's side of the conversation; the seller is fixed by the product
+    buyer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
     product = db.relationship('Product', backref='messages')
+    
+    __table_args__ = (
+        # chat(): a window of one conversation's messages, by id
+        db.Index('ix_message_thread', 'product_id', 'buyer_id', 'id'),
+    )
+
+class Job(db.Model):
+    # Background job queue, see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    idempotency_key = db.Column(db.String(200), unique=True, nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100), nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        # Workers claim the oldest ready job
+        db.Index('ix_job_status_run_at', 'status', 'run_at', 'id'),
+    )
+
+class Conversation(db.Model):
+    # One row per (product, buyer) thread, maintained by record_message() in
+    # the same transaction as each message so the inbox never has to group
+    # over the message table.
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    buyer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    seller_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=True)
+    last_sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    last_message_preview = db.Column(db.String(200), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    buyer_unread = db.Column(db.Integer, nullable=False, default=0)
+    seller_unread = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    product = db.relationship('Product')
+    buyer = db.relationship('User', foreign_keys=[buyer_id])
+    seller = db.relationship('User', foreign_keys=[seller_id])
+    
+    __table_args__ = (
+        db.UniqueConstraint('product_id', 'buyer_id', name='uq_conversation_product_buyer'),
+        # inbox(): a user's threads as buyer or seller, most recent first
+        db.Index('ix_conversation_seller_recent', 'seller_id', 'last_message_at', 'id'),
+        db.Index('ix_conversation_buyer_recent', 'buyer_id', 'last_message_at', 'id'),
+    )
+    
+    def other_party(self, user_id):
+        return self.seller if user_id == self.buyer_id else self.buyer
+    
+    def unread_for(self, user_id):
+        return self.buyer_unread if user_id == self.buyer_id else self.seller_unread
+
+facets = FacetCache(db, Product, cache, app.config['FACET_CACHE_TTL'])
+catalog = CatalogVersion(db, Product)
+fragments = FragmentCache(cache, template_fingerprint(app), app.config['FRAGMENT_CACHE_TTL'])
+jobs = JobQueue(
+    app, db, Job, app.config['JOB_BACKEND'],
+    workers=app.config['JOB_WORKERS'],
+    max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+    lock_timeout=app.config['JOB_LOCK_TIMEOUT'],
+    log=app.logger.warning
+)
+if instrumentation:
+    instrumentation.metrics.collectors.append(jobs.prometheus_lines)
+
+# Change Tracking
+# Product writes are collected on the session and acted on only once the
+# transaction commits, so caches never see changes that get rolled back.
+# Bulk query.update()/delete() calls bypass these events.
+@db.event.listens_for(Product, 'after_insert')
+@db.event.listens_for(Product, 'after_update')
+@db.event.listens_for(Product, 'after_delete')
+def track_product_change(mapper, connection, target):
+    object_session(target).info.setdefault('changed_products', set()).add(target.id)
+
+@db.event.listens_for(db.session, 'after_commit')
+def products_committed(session):
+    changed = session.info.pop('changed_products', None)
+    if changed:
+        products_changed(changed)
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def products_rolled_back(session, previous_transaction):
+    session.info.pop('changed_products', None)
+
+def products_changed(product_ids):
+    facets.invalidate()
+
+# Background Jobs
+@jobs.task('generate_thumbnails')
+def generate_thumbnails(payload):
+    media.create_thumbnails(payload['digest'])
 
 # Helper Functions
+def with_user_name(relationship):
+    # Templates only ever show a user's name next to a product or message, so
+    # join it in up front instead of lazy-loading one user per rendered row.
+    return joinedload(relationship).load_only(User.id, User.name)
+
+def init_db():
+    migrator.upgrade(log=app.logger.info)
+
+def reset_db():
+    migrator.reset()
+
 def validate_reg_number(reg_number):
     pattern = r'^[A-Z]\d{6}[A-Z]$'
     return re.match(pattern, reg_number) is not None
@@ -65,36 +250,370 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Routes
-@app.route('/')
-def index():
-    page = request.args.get('page', 1, type=int)
-    category = request.args.get('category', '')
-    search = request.args.get('search', '')
-    
-    query = Product.query.filter_by(is_available=True)
+def catalog_validators(db_session=None):
+    # (etag, last modified, whether the client's copy is fresh) for an
+    # anonymous catalogue request, or None when the page is personal
+    if 'user_id' in session or '_flashes' in session:
+        return None
+    version = catalog.current(db_session)
+    etag = f'{version["tag"]}-{fragments.fingerprint}'
+    last_modified = version['modified']
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        fresh = request.if_modified_since is not None and request.if_modified_since >= last_modified
+    return etag, last_modified, fresh
+
+def set_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+def conditional_page(f):
+    # Anonymous catalogue pages only change when a product does, so repeat
+    # visits are answered 304 Not Modified after one indexed version lookup
+    # until the catalogue version moves on. Pages for logged-in users, or
+    # with a flash message waiting, are personal and always rendered.
+    from functools import wraps
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        validators = catalog_validators()
+        if validators is None:
+            return f(*args, **kwargs)
+        
+        etag, last_modified, fresh = validators
+        if fresh:
+            response = Response(status=304)
+        else:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        return set_validators(response, etag, last_modified)
+    return decorated_function
+
+# Listing sort orders: (sort columns, descending). Each one is read in order
+# from an index, alone or after an is_available/category prefix. Searches
+# default to 'relevance', the bm25() rank.
+LISTING_SORTS = {
+    'newest': ([Product.created_at, Product.id], True),
+    'price_asc': ([Product.price, Product.id], False),
+    'price_desc': ([Product.price, Product.id], True),
+}
+
+# The sell form's conditions. Listings are only filtered by these, so a
+# filter always matches one of the condition browse indexes' prefixes.
+CONDITIONS = ['New', 'Like New', 'Good', 'Fair', 'Poor']
+
+# A price range on the newest-first listing is read from the price index and
+# sorted when it holds fewer listings than this; a wider one is cheaper to
+# filter while walking the newest-first index. Either way the first page
+# reads at most a few thousand index entries.
+PRICE_RANGE_SORT_LIMIT = 2000
+
+def price_criteria(price, min_price=None, max_price=None):
+    criteria = []
+    if min_price is not None:
+        criteria.append(price >= min_price)
+    if max_price is not None:
+        criteria.append(price <= max_price)
+    return criteria
+
+def narrow_price_range(db_session, category, condition, min_price, max_price):
+    # Counts at most PRICE_RANGE_SORT_LIMIT entries of the price index
+    query = db_session.query(Product.id).filter_by(is_available=True)
+    if category:
+        query = query.filter_by(category=category)
+    if condition:
+        query = query.filter_by(condition=condition)
+    query = query.filter(*price_criteria(Product.price, min_price, max_price))
+    matches = db_session.query(func.count()).select_from(query.limit(PRICE_RANGE_SORT_LIMIT).subquery())
+    return matches.scalar() < PRICE_RANGE_SORT_LIMIT
+
+def listing_page(category='', search='', cursor=None, per_page=8, count=False, options=None,
+                 db_session=None, condition='', min_price=None, max_price=None, sort=''):
+    # db_session defaults to the request's session; asgi.py passes its own
+    db_session = db_session or db.session
+    if options is None:
+        options = [with_user_name(Product.seller)]
+    query = db_session.query(Product).options(*options).filter_by(is_available=True)
     
     if category:
         query = query.filter_by(category=category)
+    if condition:
+        query = query.filter_by(condition=condition)
+    
+    if sort not in LISTING_SORTS and not (sort == 'relevance' and search):
+        sort = 'relevance' if search else 'newest'
+    
+    price = Product.price
+    if min_price is not None or max_price is not None:
+        # "+ 0" keeps the planner off the price index, so rows come from the
+        # search matches, or from walking the newest-first index for a wide
+        # range, instead of from probing every listing in the range
+        if search or (sort == 'newest' and not narrow_price_range(db_session, category, condition, min_price, max_price)):
+            price = Product.price + 0
+    query = query.filter(*price_criteria(price, min_price, max_price))
     
+    rank = None
     if search:
-        query = query.filter(Product.title.contains(search) | Product.description.contains(search))
+        query, rank = search_index.apply(query, Product, search)
     
-    products = query.order_by(Product.created_at.desc()).paginate(
-        page=page, per_page=8, error_out=False
+    if sort == 'relevance' and rank is not None:
+        # Best matches first; bm25() scores are lower for better matches
+        return keyset_paginate(
+            query.add_columns(rank), [rank, Product.id],
+            key=lambda row: (row[1], row[0].id), item=lambda row: row[0],
+            cursor=cursor, per_page=per_page, descending=False, count=count
+        )
+    
+    columns, descending = LISTING_SORTS.get(sort, LISTING_SORTS['newest'])
+    return keyset_paginate(
+        query, columns,
+        key=lambda product: tuple(getattr(product, column.key) for column in columns),
+        cursor=cursor, per_page=per_page, descending=descending, count=count,
+        # Newest-first cursors predate the other orders and carry no name
+        order=None if sort in ('newest', 'relevance') else sort
+    )
+
+def listing_args():
+    # The listing filters in the query string, shared by the home page and
+    # the product APIs; invalid prices and unknown conditions are ignored
+    def price(name):
+        value = request.args.get(name, type=float)
+        return value if value is not None and math.isfinite(value) and value >= 0 else None
+    condition = request.args.get('condition', '')
+    return {
+        'category': request.args.get('category', ''),
+        'search': request.args.get('search', ''),
+        'condition': condition if condition in CONDITIONS else '',
+        'min_price': price('min_price'),
+        'max_price': price('max_price'),
+        'sort': request.args.get('sort', ''),
+    }
+
+def product_to_dict(product):
+    return {
+        'id': product.id,
+        'title': product.title,
+        'description': product.description,
+        'price': product.price,
+        'category': product.category,
+        'condition': product.condition,
+        'image_url': product.image_url,
+        'seller': {'id': product.seller.id, 'name': product.seller.name},
+        'created_at': product.created_at.isoformat(),
+        'url': url_for('product_detail', product_id=product.id),
+    }
+
+def conversation_messages(product_id, buyer_id, before=None, after=None, limit=30, db_session=None):
+    # Returns (messages oldest first, whether more exist in that direction).
+    # Ids grow with time, so every window is one range over ix_message_thread.
+    query = (db_session or db.session).query(Message).options(with_user_name(Message.sender)).filter_by(
+        product_id=product_id, buyer_id=buyer_id
     )
     
-    categories = db.session.query(Product.category).distinct().all()
-    categories = [cat[0] for cat in categories]
+    if after is not None:
+        rows = query.filter(Message.id > after).order_by(Message.id.asc()).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+    
+    if before is not None:
+        query = query.filter(Message.id < before)
+    rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    return list(reversed(rows[:limit])), len(rows) > limit
+
+def conversation_buyer(product_id, buyer_id=None, db_session=None):
+    # The buyer side of the thread the current user may open on this product:
+    # their own as a buyer, or an existing buyer's thread if they are the seller.
+    if buyer_id is None or buyer_id == session['user_id']:
+        return session['user_id']
+    conversation = (db_session or db.session).query(Conversation).options(with_user_name(Conversation.buyer)).filter_by(
+        product_id=product_id, buyer_id=buyer_id
+    ).first()
+    if conversation is None or conversation.seller_id != session['user_id']:
+        abort(404)
+    g.conversation = conversation
+    return buyer_id
+
+def record_message(product, sender_id, buyer_id, content, db_session=None):
+    # Adds the message and updates its conversation summary in the current
+    # transaction; the caller commits.
+    db_session = db_session or db.session
+    threads = db_session.query(Conversation).filter_by(product_id=product.id, buyer_id=buyer_id)
+    conversation = threads.first()
+    if conversation is None:
+        values = {'product_id': product.id, 'buyer_id': buyer_id, 'seller_id': product.seller_id}
+        dialect = db_session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            # As in JobQueue.enqueue(): a savepoint would commit on release
+            # under pysqlite, so ON CONFLICT keeps the insert inside the
+            # message's transaction
+            insert = importlib.import_module(f'sqlalchemy.dialects.{dialect}').insert
+            db_session.execute(insert(Conversation).values(**values).on_conflict_do_nothing(
+                index_elements=['product_id', 'buyer_id']
+            ))
+            conversation = threads.one()
+        else:
+            try:
+                with db_session.begin_nested():
+                    conversation = Conversation(**values)
+                    db_session.add(conversation)
+            except IntegrityError:
+                # Another request opened the same thread first
+                conversation = threads.one()
+    
+    receiver_id = product.seller_id if sender_id == buyer_id else buyer_id
+    message = Message(sender_id=sender_id, receiver_id=receiver_id, product_id=product.id,
+                      buyer_id=buyer_id, content=content, timestamp=datetime.utcnow())
+    db_session.add(message)
+    db_session.flush()
+    
+    conversation.last_message_id = message.id
+    conversation.last_sender_id = sender_id
+    conversation.last_message_preview = content[:200]
+    conversation.last_message_at = message.timestamp
+    # Increment in SQL so concurrent senders do not lose updates
+    if receiver_id == buyer_id:
+        conversation.buyer_unread = Conversation.buyer_unread + 1
+    else:
+        conversation.seller_unread = Conversation.seller_unread + 1
+    return message
+
+def mark_conversation_read(product_id, buyer_id):
+    # Runs on its own connection so committing it does not expire the rows the
+    # request session has already loaded for rendering.
+    column = Conversation.buyer_unread if session['user_id'] == buyer_id else Conversation.seller_unread
+    with db.engine.begin() as connection:
+        connection.execute(update(Conversation).where(
+            Conversation.product_id == product_id,
+            Conversation.buyer_id == buyer_id,
+            column > 0
+        ).values({column: 0}))
+
+def inbox_page(cursor=None, per_page=20):
+    user_id = session['user_id']
+    query = Conversation.query.options(
+        joinedload(Conversation.product).load_only(Product.id, Product.title, Product.image_url),
+        with_user_name(Conversation.buyer),
+        with_user_name(Conversation.seller),
+    )
+    # Threads the user sells in and buys in are each read from their own
+    # recent-first index and merged, rather than sorting every thread
+    return keyset_paginate(
+        query, [Conversation.last_message_at, Conversation.id],
+        key=lambda conversation: (conversation.last_message_at, conversation.id),
+        cursor=cursor, per_page=per_page, descending=True,
+        union=[
+            [Conversation.seller_id == user_id],
+            [Conversation.buyer_id == user_id, Conversation.seller_id != user_id],
+        ]
+    )
+
+def conversation_to_dict(conversation):
+    user_id = session['user_id']
+    other = conversation.other_party(user_id)
+    return {
+        'id': conversation.id,
+        'product': {
+            'id': conversation.product.id,
+            'title': conversation.product.title,
+            'image_url': conversation.product.image_url,
+        },
+        'buyer_id': conversation.buyer_id,
+        'other_party': {'id': other.id, 'name': other.name},
+        'role': 'buyer' if user_id == conversation.buyer_id else 'seller',
+        'last_message': conversation.last_message_preview,
+        'last_message_at': conversation.last_message_at.isoformat() if conversation.last_message_at else None,
+        'last_sender_id': conversation.last_sender_id,
+        'unread': conversation.unread_for(user_id),
+        'url': url_for('chat', product_id=conversation.product_id, buyer=conversation.buyer_id),
+    }
+
+def message_to_dict(message, sender_name):
+    return {
+        'id': message.id,
+        'product_id': message.product_id,
+        'sender_id': message.sender_id,
+        'sender_name': sender_name,
+        'content': message.content,
+        'timestamp': message.timestamp.isoformat(),
+    }
+
+@app.template_global()
+def product_card(product):
+    # Listing cards are cached per product version; the Message button only
+    # shows for logged-in users other than the seller
+    show_message = bool(session.get('user_id')) and session['user_id'] != product.seller_id
+    return fragments.render(
+        lambda: render_template('_product_card.html', product=product, show_message=show_message),
+        'card', product.id, product.updated_at.isoformat(), int(show_message)
+    )
+
+# Routes
+@app.route('/')
+@conditional_page
+def index():
+    args = listing_args()
+    category = args['category']
+    search = args['search']
+    cursor = request.args.get('cursor')
+    
+    try:
+        products = listing_page(cursor=cursor, **args)
+    except InvalidCursor:
+        products = listing_page(**args)
+    
+    facet_counts = facets.get()
+    # Links keep every filter that is set; changing one starts from page one
+    filters = {name: value for name, value in args.items() if value not in ('', None)}
+    price_buckets = []
+    for bucket in facet_counts['price_buckets']:
+        # Prices have two decimals, so this matches the facet's price < max
+        max_price = round(bucket['max'] - 0.01, 2) if bucket['max'] else None
+        price_buckets.append(dict(
+            bucket,
+            active=args['min_price'] == bucket['min'] and args['max_price'] == max_price,
+            url=url_for('index', **dict(filters, min_price=bucket['min'], max_price=max_price)),
+        ))
     
     breadcrumbs = [{'name': 'Home', 'url': url_for('index')}]
     if category:
         breadcrumbs.append({'name': category, 'url': url_for('index', category=category)})
     
-    return render_template('index.html', products=products, categories=categories, 
-                         current_category=category, search=search, breadcrumbs=breadcrumbs)
+    return render_template('index.html', products=products, categories=facet_counts['categories'],
+                         conditions=facet_counts['conditions'], price_buckets=price_buckets,
+                         current_category=category, search=search, filters=filters,
+                         breadcrumbs=breadcrumbs)
+
+@app.route('/api/products')
+def api_products():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    
+    try:
+        page = listing_page(
+            cursor=request.args.get('cursor'),
+            per_page=limit,
+            count=request.args.get('count', '') == '1',
+            **listing_args()
+        )
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    response = {
+        'products': [product_to_dict(product) for product in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }
+    if page.total is not None:
+        response['total'] = page.total
+    return jsonify(response)
+
+@app.route('/api/facets')
+def api_facets():
+    return jsonify(facets.get())
 
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limiter.limit(app.config['RATELIMIT_LOGIN'], by='ip', methods=['POST'])
 def login():
     if request.method == 'POST':
         try:
@@ -106,30 +625,50 @@ def login():
                 return render_template('login.html')
             
             # Check if identifier is email or reg number
-            user = None
+            if '@' not in identifier:
+                identifier = identifier.upper()
+                if not validate_reg_number(identifier):
+                    flash('Invalid registration number format. Use format: H200000A', 'error')
+                    return render_template('login.html')
+            
+            # Refuse repeated failures before doing any password hash work
+            address = request.remote_addr
+            retry_after = login_throttle.retry_after(identifier.lower(), address)
+            if retry_after:
+                flash(f'Too many failed login attempts. Please try again in {int(retry_after) // 60 + 1} minutes.', 'error')
+                return render_template('login.html'), 429, {'Retry-After': str(int(retry_after) + 1)}
+            
             if '@' in identifier:
                 user = User.query.filter_by(email=identifier).first()
             else:
-                if not validate_reg_number(identifier.upper()):
-                    flash('Invalid registration number format. Use format: H200000A', 'error')
-                    return render_template('login.html')
-                user = User.query.filter_by(reg_number=identifier.upper()).first()
+                user = User.query.filter_by(reg_number=identifier).first()
             
-            if user and check_password_hash(user.password_hash, password):
+            if user and password_hasher.verify(user.password_hash, password):
+                login_throttle.succeeded(identifier.lower())
+                if password_hasher.needs_rehash(user.password_hash):
+                    # Upgrade hashes made with an older method or cost
+                    user.password_hash = password_hasher.hash(password)
+                    db.session.commit()
                 session['user_id'] = user.id
                 session['user_name'] = user.name
                 flash(f'Welcome back, {user.name}!', 'success')
                 return redirect(url_for('index'))
             else:
+                login_throttle.failed(identifier.lower(), address)
                 flash('Invalid credentials. Please try again.', 'error')
-                
+        
+        except HasherBusy:
+            flash('The server is busy right now. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503, {'Retry-After': '5'}
         except Exception as e:
+            db.session.rollback()
             flash('An error occurred during login. Please try again.', 'error')
             app.logger.error(f'Login error: {str(e)}')
     
     return render_template('login.html')
 
 @app.route('/register', methods=['GET', 'POST'])
+@rate_limiter.limit(app.config['RATELIMIT_REGISTER'], by='ip', algorithm=SlidingWindow.name, methods=['POST'])
 def register():
     if request.method == 'POST':
         try:
@@ -174,7 +713,7 @@ def register():
                 name=name,
                 email=email if email else None,
                 reg_number=reg_number if reg_number else None,
-                password_hash=generate_password_hash(password)
+                password_hash=password_hasher.hash(password)
             )
             
             db.session.add(user)
@@ -183,6 +722,9 @@ def register():
             flash('Registration successful! Please log in.', 'success')
             return redirect(url_for('login'))
             
+        except HasherBusy:
+            flash('The server is busy right now. Please try again in a moment.', 'error')
+            return render_template('register.html'), 503, {'Retry-After': '5'}
         except Exception as e:
             db.session.rollback()
             flash('An error occurred during registration. Please try again.', 'error')
@@ -197,14 +739,43 @@ def logout():
     return redirect(url_for('index'))
 
 @app.route('/product/<int:product_id>')
+@conditional_page
 def product_detail(product_id):
-    product = Product.query.get_or_404(product_id)
+    # Everything but the session-dependent actions comes from the fragment
+    # cache, so a warm product page needs no SQL
+    version = catalog.product(product_id)
+    detail = fragments.get('detail', product_id, version)
+    if detail is None:
+        product = Product.query.options(with_user_name(Product.seller)).filter_by(id=product_id).first_or_404()
+        detail = {
+            'id': product.id,
+            'title': product.title,
+            'category': product.category,
+            'image_url': product.image_url,
+            'image_hash': product.image_hash,
+            'seller_id': product.seller_id,
+            'html': render_template('_product_detail.html', product=product),
+        }
+        fragments.set(detail, 'detail', product_id, version)
+    
     breadcrumbs = [
         {'name': 'Home', 'url': url_for('index')},
-        {'name': product.category, 'url': url_for('index', category=product.category)},
-        {'name': product.title, 'url': ''}
+        {'name': detail['category'], 'url': url_for('index', category=detail['category'])},
+        {'name': detail['title'], 'url': ''}
     ]
-    return render_template('product_detail.html', product=product, breadcrumbs=breadcrumbs)
+    return render_template('product_detail.html', product=detail, detail_html=Markup(detail['html']),
+                         breadcrumbs=breadcrumbs)
+
+@app.route('/media/<size>/<digest>.<ext>')
+def media_file(size, digest, ext):
+    # The URL names the image content, so the response never changes
+    try:
+        path = media.thumbnail(size, digest, ext)
+    except LookupError:
+        abort(404)
+    response = send_file(path, mimetype=media.mimetype(ext), max_age=app.config['MEDIA_MAX_AGE'])
+    response.cache_control.immutable = True
+    return response
 
 @app.route('/sell', methods=['GET', 'POST'])
 @login_required
@@ -217,19 +788,33 @@ def sell_product():
             category = request.form.get('category', '').strip()
             condition = request.form.get('condition', '').strip()
             image_url = request.form.get('image_url', '').strip()
+            upload = request.files.get('image')
             
             if not all([title, description, price, category, condition]):
                 flash('Please fill in all required fields.', 'error')
                 return render_template('sell.html')
             
+            if condition not in CONDITIONS:
+                flash('Please select a valid condition.', 'error')
+                return render_template('sell.html')
+            
             try:
-                price = float(price)
-                if price <= 0:
+                # Whole cents, which the price filters and buckets rely on
+                price = round(float(price), 2)
+                if not math.isfinite(price) or price <= 0:
                     raise ValueError()
             except ValueError:
                 flash('Please enter a valid price.', 'error')
                 return render_template('sell.html')
             
+            image_hash = None
+            if upload and upload.filename:
+                try:
+                    image_hash = media.save(upload)
+                except UploadError as e:
+                    flash(str(e), 'error')
+                    return render_template('sell.html')
+            
             product = Product(
                 title=title,
                 description=description,
@@ -237,10 +822,13 @@ def sell_product():
                 category=category,
                 condition=condition,
                 image_url=image_url if image_url else '/placeholder.svg?height=300&width=300',
+                image_hash=image_hash,
                 seller_id=session['user_id']
             )
             
             db.session.add(product)
+            if image_hash:
+                jobs.enqueue('generate_thumbnails', {'digest': image_hash}, key=f'thumbnails:{image_hash}')
             db.session.commit()
             
             flash('Product listed successfully!', 'success')
@@ -260,16 +848,23 @@ def sell_product():
 @app.route('/chat/<int:product_id>')
 @login_required
 def chat(product_id):
-    product = Product.query.get_or_404(product_id)
+    product = Product.query.options(with_user_name(Product.seller)).filter_by(id=product_id).first_or_404()
+    buyer_arg = request.args.get('buyer', type=int)
     
-    if product.seller_id == session['user_id']:
+    if product.seller_id == session['user_id'] and buyer_arg is None:
         flash('You cannot message yourself about your own product.', 'error')
         return redirect(url_for('product_detail', product_id=product_id))
     
-    messages = Message.query.filter_by(product_id=product_id).filter(
-        ((Message.sender_id == session['user_id']) & (Message.receiver_id == product.seller_id)) |
-        ((Message.sender_id == product.seller_id) & (Message.receiver_id == session['user_id']))
-    ).order_by(Message.timestamp.asc()).all()
+    buyer_id = conversation_buyer(product_id, buyer_arg)
+    if buyer_id == session['user_id']:
+        other_party = product.seller
+    else:
+        other_party = g.conversation.buyer
+    
+    messages, has_older = conversation_messages(
+        product_id, buyer_id, limit=app.config['CHAT_PAGE_SIZE']
+    )
+    mark_conversation_read(product_id, buyer_id)
     
     breadcrumbs = [
         {'name': 'Home', 'url': url_for('index')},
@@ -277,42 +872,148 @@ def chat(product_id):
         {'name': 'Chat', 'url': ''}
     ]
     
-    return render_template('chat.html', product=product, messages=messages, breadcrumbs=breadcrumbs)
+    return render_template('chat.html', product=product, messages=messages, has_older=has_older,
+                         buyer_id=buyer_id, other_party=other_party, breadcrumbs=breadcrumbs)
+
+@app.route('/chat/<int:product_id>/events')
+@login_required
+def chat_events(product_id):
+    # Server-Sent Events stream of new messages in this conversation. The
+    # generator never touches the database, so an open stream only holds a
+    # worker thread and a broker subscription.
+    buyer_id = conversation_buyer(product_id, request.args.get('buyer', type=int))
+    channel = conversation_channel(product_id, buyer_id)
+    keepalive = app.config['CHAT_KEEPALIVE']
+    
+    # Subscribe before catching up so nothing sent in between is lost; the
+    # browser ignores ids it has already rendered. EventSource sends the id
+    # of the last event it saw when it reconnects.
+    subscription = broker.subscribe(channel)
+    missed = []
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    if last_event_id is not None:
+        missed, _ = conversation_messages(product_id, buyer_id, after=last_event_id,
+                                          limit=app.config['CHAT_PAGE_SIZE'])
+        missed = [message_to_dict(message, message.sender.name) for message in missed]
+    
+    def stream():
+        yield 'retry: 3000\n\n'
+        for message in missed:
+            yield format_event(message)
+        while True:
+            message = subscription.get(timeout=keepalive)
+            if message is None:
+                yield ': keepalive\n\n'
+            else:
+                yield format_event(message)
+    
+    response = Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(subscription.close)
+    return response
+
+@app.route('/api/chat/<int:product_id>/messages')
+@login_required
+def api_chat_messages(product_id):
+    limit = min(max(request.args.get('limit', app.config['CHAT_PAGE_SIZE'], type=int), 1), 100)
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    
+    buyer_id = conversation_buyer(product_id, request.args.get('buyer', type=int))
+    
+    messages, has_more = conversation_messages(product_id, buyer_id, before, after, limit)
+    return jsonify({
+        'messages': [message_to_dict(message, message.sender.name) for message in messages],
+        'has_more': has_more,
+    })
+
+@app.route('/api/chat/<int:product_id>/read', methods=['POST'])
+@login_required
+def api_chat_read(product_id):
+    buyer_id = conversation_buyer(product_id, request.args.get('buyer', type=int))
+    mark_conversation_read(product_id, buyer_id)
+    return jsonify({'success': True})
+
+@app.route('/inbox')
+@login_required
+def inbox():
+    try:
+        conversations = inbox_page(request.args.get('cursor'))
+    except InvalidCursor:
+        conversations = inbox_page()
+    
+    breadcrumbs = [
+        {'name': 'Home', 'url': url_for('index')},
+        {'name': 'Inbox', 'url': ''}
+    ]
+    return render_template('inbox.html', conversations=conversations, breadcrumbs=breadcrumbs)
+
+@app.route('/api/inbox')
+@login_required
+def api_inbox():
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    try:
+        page = inbox_page(request.args.get('cursor'), per_page=limit)
+    except InvalidCursor:
+        return jsonify({'error': 'Invalid cursor'}), 400
+    
+    return jsonify({
+        'conversations': [conversation_to_dict(conversation) for conversation in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    })
+
+def post_message(data, db_session=None):
+    # Records a chat message from the current user and commits it. Returns
+    # (response body, status, (channel, event) to publish or None).
+    db_session = db_session or db.session
+    product_id = data.get('product_id')
+    content = data.get('content', '').strip()
+    
+    if not content:
+        return {'error': 'Message cannot be empty'}, 400, None
+    
+    product = db_session.get(Product, product_id) if product_id is not None else None
+    if product is None:
+        return {'error': 'Product not found'}, 404, None
+    
+    if product.seller_id == session['user_id']:
+        # Sellers can only reply within a thread a buyer has started
+        buyer_id = data.get('buyer_id')
+        buyer_id = int(buyer_id) if str(buyer_id).isascii() and str(buyer_id).isdigit() else None
+        if not buyer_id or buyer_id == session['user_id']:
+            return {'error': 'Cannot message yourself'}, 400, None
+        if not db_session.query(Conversation).filter_by(product_id=product.id, buyer_id=buyer_id).first():
+            return {'error': 'Conversation not found'}, 404, None
+    else:
+        buyer_id = session['user_id']
+    
+    message = record_message(product, session['user_id'], buyer_id, content, db_session)
+    # Serialise before committing; the commit expires the message
+    payload = message_to_dict(message, session['user_name'])
+    timestamp = message.timestamp
+    db_session.commit()
+    
+    body = {
+        'success': True,
+        'message': dict(payload, timestamp=timestamp.strftime('%Y-%m-%d %H:%M:%S'))
+    }
+    return body, 200, (conversation_channel(payload['product_id'], buyer_id), payload)
+
+# Shared with the async view in asgi.py
+limit_send_message = rate_limiter.limit(app.config['RATELIMIT_SEND_MESSAGE'], by='user')
 
 @app.route('/send_message', methods=['POST'])
 @login_required
+@limit_send_message
 def send_message():
     try:
-        data = request.get_json()
-        product_id = data.get('product_id')
-        content = data.get('content', '').strip()
-        
-        if not content:
-            return jsonify({'error': 'Message cannot be empty'}), 400
-        
-        product = Product.query.get_or_404(product_id)
-        
-        if product.seller_id == session['user_id']:
-            return jsonify({'error': 'Cannot message yourself'}), 400
-        
-        message = Message(
-            sender_id=session['user_id'],
-            receiver_id=product.seller_id,
-            product_id=product_id,
-            content=content
-        )
-        
-        db.session.add(message)
-        db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'message': {
-                'content': content,
-                'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                'sender_name': session['user_name']
-            }
-        })
+        body, status, event = post_message(request.get_json())
+        if event is not None:
+            broker.publish(*event)
+        return jsonify(body), status
         
     except Exception as e:
         db.session.rollback()
@@ -329,16 +1030,244 @@ def my_products():
     ]
     return render_template('my_products.html', products=products, breadcrumbs=breadcrumbs)
 
+# API v1
+# Read access to products, public user profiles and the current user's
+# messages. Every collection takes ?fields= and ?ids=, see api.py. Product
+# responses are public and carry the catalogue ETag.
+api_v1 = create_api_blueprint(
+    'api_v1', '/api/v1', db,
+    min_size=app.config['API_COMPRESSION_MIN_BYTES'],
+    level=app.config['API_COMPRESSION_LEVEL']
+)
+
+def isoformat(value):
+    return value.isoformat() if value else None
+
+def product_images(product):
+    if not product.image_hash:
+        return None
+    return {
+        size: {ext: url_for('media_file', size=size, digest=product.image_hash, ext=ext)
+               for ext in ('webp', 'jpg')}
+        for size in ('grid', 'detail')
+    }
+
+# The field sets below refer to backref relationships such as Product.seller,
+# which only exist once the mappers are configured
+configure_mappers()
+
+product_fields = FieldSet({
+    'id': Field(lambda product: product.id, [Product.id]),
+    'title': Field(lambda product: product.title, [Product.title]),
+    'description': Field(lambda product: product.description, [Product.description]),
+    'price': Field(lambda product: product.price, [Product.price]),
+    'category': Field(lambda product: product.category, [Product.category]),
+    'condition': Field(lambda product: product.condition, [Product.condition]),
+    'image_url': Field(lambda product: product.image_url, [Product.image_url]),
+    'images': Field(product_images, [Product.image_hash]),
+    'seller': Field(lambda product: {'id': product.seller.id, 'name': product.seller.name},
+                    [Product.seller_id], Product.seller, [User.id, User.name]),
+    'is_available': Field(lambda product: product.is_available, [Product.is_available]),
+    'created_at': Field(lambda product: isoformat(product.created_at), [Product.created_at]),
+    'updated_at': Field(lambda product: isoformat(product.updated_at), [Product.updated_at]),
+    'url': Field(lambda product: url_for('product_detail', product_id=product.id)),
+}, default=['id', 'title', 'price', 'category', 'condition', 'image_url', 'images', 'seller', 'created_at'],
+   key_columns=[Product.id, Product.created_at, Product.price])
+
+# Only what the site already shows next to a listing; never email or
+# registration number
+user_fields = FieldSet({
+    'id': Field(lambda user: user.id, [User.id]),
+    'name': Field(lambda user: user.name, [User.name]),
+    'created_at': Field(lambda user: isoformat(user.created_at), [User.created_at]),
+}, key_columns=[User.id])
+
+message_fields = FieldSet({
+    'id': Field(lambda message: message.id, [Message.id]),
+    'product_id': Field(lambda message: message.product_id, [Message.product_id]),
+    'buyer_id': Field(lambda message: message.buyer_id, [Message.buyer_id]),
+    'sender': Field(lambda message: {'id': message.sender.id, 'name': message.sender.name},
+                    [Message.sender_id], Message.sender, [User.id, User.name]),
+    'receiver_id': Field(lambda message: message.receiver_id, [Message.receiver_id]),
+    'content': Field(lambda message: message.content, [Message.content]),
+    'timestamp': Field(lambda message: isoformat(message.timestamp), [Message.timestamp]),
+}, key_columns=[Message.id])
+
+def api_login_required(f):
+    from functools import wraps
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            raise ApiError('Authentication required', 401)
+        return f(*args, **kwargs)
+    return decorated_function
+
+def batch_get(model, fields, ids, names, *criteria, db_session=None):
+    # One IN query for every id; results keep the requested order and ids
+    # that do not exist (or are not visible) are listed as missing
+    query = (db_session or db.session).query(model).options(*fields.options(names))
+    rows = query.filter(model.id.in_(ids), *criteria).all()
+    found = {row.id: row for row in rows}
+    return [fields.dump(found[id], names) for id in ids if id in found], [id for id in ids if id not in found]
+
+def api_page(page, fields, names, key):
+    response = {
+        key: [fields.dump(item, names) for item in page.items],
+        'next_cursor': page.next_cursor,
+        'prev_cursor': page.prev_cursor,
+    }
+    if page.total is not None:
+        response['total'] = page.total
+    return response
+
+def products_response(db_session=None):
+    # Body of GET /api/v1/products, also served by asgi.py
+    names = product_fields.parse(request.args.get('fields'))
+    if request.args.get('ids'):
+        products, missing = batch_get(Product, product_fields, parse_ids(request.args['ids']), names,
+                                      db_session=db_session)
+        return {'products': products, 'missing': missing}
+    
+    args = listing_args()
+    if args['sort'] and args['sort'] not in LISTING_SORTS and args['sort'] != 'relevance':
+        raise ApiError(f'Unknown sort: {args["sort"]}. Available: relevance, {", ".join(LISTING_SORTS)}')
+    condition = request.args.get('condition', '')
+    if condition and condition not in CONDITIONS:
+        raise ApiError(f'Unknown condition: {condition}. Available: {", ".join(CONDITIONS)}')
+    try:
+        page = listing_page(
+            cursor=request.args.get('cursor'),
+            per_page=page_limit(),
+            count=request.args.get('count', '') == '1',
+            options=product_fields.options(names),
+            db_session=db_session,
+            **args
+        )
+    except InvalidCursor:
+        raise ApiError('Invalid cursor')
+    return api_page(page, product_fields, names, 'products')
+
+@api_v1.route('/products')
+@conditional_page
+def api_v1_products():
+    return jsonify(products_response())
+
+@api_v1.route('/products/<int:product_id>')
+@conditional_page
+def api_v1_product(product_id):
+    names = product_fields.parse(request.args.get('fields'))
+    product = Product.query.options(*product_fields.options(names)).filter_by(id=product_id).first_or_404()
+    return jsonify(product_fields.dump(product, names))
+
+@api_v1.route('/users')
+def api_v1_users():
+    if not request.args.get('ids'):
+        raise ApiError('ids is required')
+    names = user_fields.parse(request.args.get('fields'))
+    users, missing = batch_get(User, user_fields, parse_ids(request.args['ids']), names)
+    return jsonify({'users': users, 'missing': missing})
+
+@api_v1.route('/users/<int:user_id>')
+def api_v1_user(user_id):
+    names = user_fields.parse(request.args.get('fields'))
+    user = User.query.options(*user_fields.options(names)).filter_by(id=user_id).first_or_404()
+    return jsonify(user_fields.dump(user, names))
+
+@api_v1.route('/users/<int:user_id>/products')
+@conditional_page
+def api_v1_user_products(user_id):
+    # A seller's available listings, newest first (ix_product_seller_created)
+    names = product_fields.parse(request.args.get('fields'))
+    query = Product.query.options(*product_fields.options(names)).filter_by(
+        seller_id=user_id, is_available=True
+    )
+    try:
+        page = keyset_paginate(
+            query, [Product.created_at, Product.id],
+            key=lambda product: (product.created_at, product.id),
+            cursor=request.args.get('cursor'), per_page=page_limit(), descending=True
+        )
+    except InvalidCursor:
+        raise ApiError('Invalid cursor')
+    return jsonify(api_page(page, product_fields, names, 'products'))
+
+@api_v1.route('/messages')
+@api_login_required
+def api_v1_messages():
+    # Either ?ids= of messages the user sent or received, or one conversation
+    # (?product_id=&buyer=) newest first
+    names = message_fields.parse(request.args.get('fields'))
+    user_id = session['user_id']
+    if request.args.get('ids'):
+        messages, missing = batch_get(
+            Message, message_fields, parse_ids(request.args['ids']), names,
+            or_(Message.sender_id == user_id, Message.receiver_id == user_id)
+        )
+        return jsonify({'messages': messages, 'missing': missing})
+    
+    product_id = request.args.get('product_id', type=int)
+    if product_id is None:
+        raise ApiError('product_id or ids is required')
+    buyer_id = conversation_buyer(product_id, request.args.get('buyer', type=int))
+    query = Message.query.options(*message_fields.options(names)).filter_by(
+        product_id=product_id, buyer_id=buyer_id
+    )
+    try:
+        page = keyset_paginate(
+            query, [Message.id], key=lambda message: (message.id,),
+            cursor=request.args.get('cursor'), per_page=page_limit(app.config['CHAT_PAGE_SIZE']),
+            descending=True
+        )
+    except InvalidCursor:
+        raise ApiError('Invalid cursor')
+    return jsonify(api_page(page, message_fields, names, 'messages'))
+
+app.register_blueprint(api_v1)
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('error.html', error_code=404, error_message='Page not found'), 404
 
+@app.errorhandler(413)
+def too_large_error(error):
+    return render_template('error.html', error_code=413,
+                           error_message=f'Uploads can be at most {app.config["UPLOAD_MAX_BYTES"] // (1024 * 1024)} MB'), 413
+
+@app.errorhandler(429)
+def too_many_requests_error(error):
+    headers = {'Retry-After': str(error.retry_after)} if error.retry_after else {}
+    if request.is_json or request.blueprint == 'api_v1':
+        return jsonify({'error': 'Too many requests. Please try again later.'}), 429, headers
+    return render_template('error.html', error_code=429, error_message='Too many requests'), 429, headers
+
 @app.errorhandler(500)
 def internal_error(error):
     db.session.rollback()
     return render_template('error.html', error_code=500, error_message='Internal server error'), 500
 
+@app.cli.command('migrate')
+def migrate_command():
+    migrator.upgrade(log=print)
+    print(f'Database schema is at version {migrator.current_version()}.')
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True, help='Exit once no jobs are ready.')
+@click.option('--poll-interval', default=1.0, help='Seconds to wait when the queue is empty.')
+def worker_command(burst, poll_interval):
+    if jobs.backend != 'database':
+        raise click.ClickException('Set JOB_BACKEND=database to process jobs with a worker.')
+    jobs.work(burst=burst, poll_interval=poll_interval, log=print)
+
+@app.cli.command('jobs')
+def jobs_command():
+    print(json.dumps(jobs.stats(), indent=2))
+
+@app.cli.command('rebuild-search')
+def rebuild_search_command():
+    search_index.rebuild()
+    print(f'Rebuilt {search_index.backend.name} search index.')
+
 if __name__ == '__main__':
     with app.app_context():
-        db.create_all()
+        init_db()
     app.run(debug=True)
@@ -0,0 +1,317 @@
+import asyncio
+import inspect
+import io
+import sys
+
+from flask import Response, jsonify, request
+from werkzeug.exceptions import HTTPException
+
+from app import (app, broker, catalog_validators, conversation_buyer, conversation_messages, db, jobs,
+                 limit_send_message, login_required, message_to_dict, password_hasher, post_message,
+                 products_response, search_index, set_validators)
+from database import async_database_url, configure_sqlite, engine_options
+from realtime import conversation_channel, format_event
+
+# ASGI entry point, for serving many long-lived connections from a few
+# processes:
+#
+#     uvicorn asgi:application --workers 4
+#
+# The chat event stream, sending messages and the product listing API run as
+# coroutines against an asyncio database engine, so an open chat holds a
+# socket and a queue instead of a thread. Every other route is the unchanged
+# Flask app running on a thread pool, as are all routes when no asyncio
+# driver is installed for the database.
+
+try:
+    from asgiref.sync import ThreadSensitiveContext
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    raise RuntimeError('ASGI mode requires asgiref (pip install asgiref uvicorn aiosqlite)')
+
+
+class ThreadedWsgi(WsgiToAsgi):
+    # asgiref runs every WSGI request on one shared thread by default. Inside
+    # a ThreadSensitiveContext a request gets a thread of its own instead,
+    # and the semaphore caps how many run at once.
+    def __init__(self, wsgi_application, max_threads):
+        super().__init__(wsgi_application)
+        self.slots = asyncio.Semaphore(max_threads)
+
+    async def __call__(self, scope, receive, send):
+        async with self.slots:
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+
+def create_async_session():
+    try:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        with app.app_context():
+            url = app.config['ASYNC_DATABASE_URL'] or async_database_url(db.engine.url)
+        engine = create_async_engine(url, **engine_options(app.config))
+    except (ImportError, ValueError) as e:
+        app.logger.warning(f'Serving every route on threads, no asyncio database driver: {e}')
+        return None, None
+    configure_sqlite(engine.sync_engine, app.config)
+    return engine, async_sessionmaker(engine, expire_on_commit=False)
+
+
+sync_app = ThreadedWsgi(app, app.config['ASGI_SYNC_THREADS'])
+async_engine, async_session = create_async_session()
+url_adapter = app.url_map.bind('localhost')
+
+
+class EventStream:
+    # Returned by async views to keep sending chunks until the client leaves
+    def __init__(self, chunks, on_close=None):
+        self.chunks = chunks
+        self.on_close = on_close
+
+    def response(self):
+        return Response(mimetype='text/event-stream', headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no',
+        })
+
+    def close(self):
+        if self.on_close is not None:
+            self.on_close()
+
+
+# Async views, keyed by the endpoint of the Flask route they replace so URLs
+# are still defined in one place. They run in a Flask request context, so
+# session, request, url_for, login_required and error handlers all work;
+# database work goes through AsyncSession.run_sync() with the same query
+# helpers as the sync routes.
+async_views = {}
+
+
+def async_view(endpoint):
+    def decorator(f):
+        async_views[endpoint] = f
+        return f
+    return decorator
+
+
+async def publish(channel, payload):
+    # A Redis publish is a blocking network call
+    await asyncio.get_running_loop().run_in_executor(None, broker.publish, channel, payload)
+
+
+@async_view('api_v1.api_v1_products')
+async def api_v1_products():
+    async with async_session() as db_session:
+        validators = await db_session.run_sync(catalog_validators)
+        if validators is not None and validators[2]:
+            return set_validators(Response(status=304), *validators[:2])
+        body = await db_session.run_sync(products_response)
+    response = jsonify(body)
+    if validators is not None:
+        set_validators(response, *validators[:2])
+    return response
+
+
+@async_view('send_message')
+@login_required
+@limit_send_message
+async def send_message():
+    async with async_session() as db_session:
+        try:
+            data = request.get_json()
+            body, status, event = await db_session.run_sync(lambda s: post_message(data, s))
+        except Exception as e:
+            await db_session.rollback()
+            app.logger.error(f'Send message error: {str(e)}')
+            return jsonify({'error': 'Failed to send message'}), 500
+    if event is not None:
+        await publish(*event)
+    return jsonify(body), status
+
+
+@async_view('chat_events')
+@login_required
+async def chat_events(product_id):
+    buyer_arg = request.args.get('buyer', type=int)
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    keepalive = app.config['CHAT_KEEPALIVE']
+    limit = app.config['CHAT_PAGE_SIZE']
+
+    async with async_session() as db_session:
+        buyer_id = await db_session.run_sync(lambda s: conversation_buyer(product_id, buyer_arg, s))
+
+        def missed_messages(s):
+            messages, _ = conversation_messages(product_id, buyer_id, after=last_event_id,
+                                                limit=limit, db_session=s)
+            return [message_to_dict(message, message.sender.name) for message in messages]
+
+        # Subscribe before catching up, as in the sync view
+        subscription = broker.subscribe(conversation_channel(product_id, buyer_id),
+                                        asyncio.get_running_loop())
+        try:
+            missed = await db_session.run_sync(missed_messages) if last_event_id is not None else []
+        except BaseException:
+            subscription.close()
+            raise
+
+    async def stream():
+        yield 'retry: 3000\n\n'
+        for message in missed:
+            yield format_event(message)
+        while True:
+            message = await subscription.get(timeout=keepalive)
+            yield ': keepalive\n\n' if message is None else format_event(message)
+
+    return EventStream(stream(), on_close=subscription.close)
+
+
+# ASGI plumbing
+def build_environ(scope, body):
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def match_async_view(scope):
+    if async_session is None:
+        return None
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    try:
+        endpoint, _ = url_adapter.match(path, method=scope['method'])
+    except HTTPException:
+        # Not found, wrong method or a redirect: let Flask answer
+        return None
+    return async_views.get(endpoint)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+    return b''.join(chunks)
+
+
+async def call_view(view):
+    # Flask's full_dispatch_request() for a view that may be a coroutine
+    stream = None
+    try:
+        try:
+            rv = app.preprocess_request()
+            if rv is None:
+                rv = view(**request.view_args)
+                if inspect.isawaitable(rv):
+                    rv = await rv
+            if isinstance(rv, EventStream):
+                stream, rv = rv, rv.response()
+        except Exception as e:
+            rv = app.handle_user_exception(e)
+        return app.finalize_request(rv), stream
+    except Exception as e:
+        if stream is not None:
+            stream.close()
+        return app.handle_exception(e), None
+
+
+async def send_stream(stream, receive, send):
+    async def pump():
+        async for chunk in stream.chunks:
+            await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def disconnected():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        stream.close()
+
+
+async def dispatch(scope, receive, send, view):
+    body = await read_body(receive)
+    with app.request_context(build_environ(scope, body)):
+        response, stream = await call_view(view)
+
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in response.headers.to_wsgi_list()],
+        })
+        if stream is not None:
+            await send_stream(stream, receive, send)
+            stream = None
+        else:
+            data = b'' if scope['method'] == 'HEAD' else response.get_data()
+            await send({'type': 'http.response.body', 'body': data})
+    finally:
+        if stream is not None:
+            stream.close()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Detect the search backend now rather than on the event loop
+            # during the first search
+            with app.app_context():
+                search_index.backend
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if async_engine is not None:
+                await async_engine.dispose()
+            jobs.shutdown(wait=False)
+            password_hasher.shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        view = match_async_view(scope)
+        if view is None:
+            await sync_app(scope, receive, send)
+        else:
+            await dispatch(scope, receive, send, view)
+    elif scope['type'] == 'websocket':
+        await send({'type': 'websocket.close'})
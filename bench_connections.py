@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import http.cookiejar
+import importlib.util
+import json
+import os
+import resource
+import shutil
+import signal
+import sys
+import time
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from bench_login import percentile
+from bench_routes import Fixture, build_database, free_port, git_commit, launch_server
+
+# Concurrent connection capacity of each way of serving the app. Holds
+# --connections open chat event streams (the long-lived connections that
+# each tie up a thread under WSGI), then, while they stay open, measures the
+# latency of ordinary API requests and how long one new message takes to
+# reach every stream:
+#
+#     python bench_connections.py --connections 100 500 1000
+#     python bench_connections.py --servers werkzeug uvicorn --workers 2
+#
+# werkzeug is app.run() (one thread per connection), gunicorn uses gthread
+# workers with --threads each, and uvicorn serves asgi.py. Results are saved
+# under benchmarks/ like bench_routes.py.
+
+SERVERS = ['werkzeug', 'gunicorn', 'uvicorn']
+PROBE_PATH = '/api/v1/products?fields=id,title,price'
+
+
+def server_command(name, port, args):
+    if name == 'werkzeug':
+        return [sys.executable, '-c', f'from app import app; app.run(port={port}, threaded=True)']
+    if name == 'gunicorn':
+        return ['gunicorn', '-w', str(args.workers), '-k', 'gthread', '--threads', str(args.threads),
+                '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app']
+    return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(port),
+            '--workers', str(args.workers), '--log-level', 'warning']
+
+
+def available(name):
+    if name == 'gunicorn':
+        return shutil.which('gunicorn') is not None
+    if name == 'uvicorn':
+        return all(importlib.util.find_spec(module) for module in ('uvicorn', 'asgiref'))
+    return True
+
+
+def process_group_usage(pgid):
+    # (threads, resident MB) summed over the server's processes; Linux only
+    threads = rss_kb = 0
+    try:
+        pids = [pid for pid in os.listdir('/proc') if pid.isdigit()]
+    except OSError:
+        return None, None
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                if int(f.read().rsplit(')', 1)[1].split()[2]) != pgid:
+                    continue
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+                    elif line.startswith('VmRSS:'):
+                        rss_kb += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+    return threads, round(rss_kb / 1024, 1)
+
+
+def login_cookie(base_url, email):
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({'identifier': email, 'password': 'password123'}).encode()
+    opener.open(base_url + '/login', data=form, timeout=30).read()
+    return '; '.join(f'{cookie.name}={cookie.value}' for cookie in jar)
+
+
+async def http_request(port, method, path, cookie=None, body=None, timeout=10):
+    # One request on its own connection; returns the status code
+    reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    try:
+        data = json.dumps(body).encode() if body is not None else b''
+        head = f'{method} {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nConnection: close\r\n'
+        if cookie:
+            head += f'Cookie: {cookie}\r\n'
+        if body is not None:
+            head += 'Content-Type: application/json\r\n'
+        head += f'Content-Length: {len(data)}\r\n\r\n'
+        writer.write(head.encode() + data)
+        response = await asyncio.wait_for(reader.read(), timeout)
+        return int(response.split(b' ', 2)[1])
+    finally:
+        writer.close()
+
+
+class EventStream:
+    def __init__(self, port, path, cookie):
+        self.port = port
+        self.path = path
+        self.cookie = cookie
+        self.buffer = b''
+        self.reader = self.writer = None
+
+    async def read_until(self, marker, timeout):
+        deadline = time.monotonic() + timeout
+        while marker not in self.buffer:
+            chunk = await asyncio.wait_for(self.reader.read(4096), max(deadline - time.monotonic(), 0.001))
+            if not chunk:
+                raise ConnectionError('stream closed')
+            self.buffer += chunk
+
+    async def open(self, timeout):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection('127.0.0.1', self.port), timeout
+        )
+        self.writer.write((f'GET {self.path} HTTP/1.1\r\nHost: 127.0.0.1:{self.port}\r\n'
+                           f'Cookie: {self.cookie}\r\nAccept: text/event-stream\r\n\r\n').encode())
+        await self.read_until(b'retry:', timeout)
+
+    async def wait_message(self, timeout):
+        await self.read_until(b'event: message', timeout)
+        return time.perf_counter()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def measure(port, pgid, fixture, cookie, connections, args):
+    path = f'/chat/{fixture.threads[0]}/events'
+    streams = [EventStream(port, path, cookie) for _ in range(connections)]
+    connecting = asyncio.Semaphore(100)
+
+    async def open_stream(stream):
+        async with connecting:
+            try:
+                await stream.open(args.timeout)
+                return True
+            except (OSError, asyncio.TimeoutError):
+                stream.close()
+                return False
+
+    started = time.perf_counter()
+    opened = await asyncio.gather(*[open_stream(stream) for stream in streams])
+    open_seconds = time.perf_counter() - started
+    streams = [stream for stream, ok in zip(streams, opened) if ok]
+    threads, rss_mb = process_group_usage(pgid)
+
+    # Ordinary requests while every stream is held open
+    latencies, errors = [], 0
+    probing = asyncio.Semaphore(args.probe_concurrency)
+
+    async def probe():
+        nonlocal errors
+        async with probing:
+            began = time.perf_counter()
+            try:
+                status = await http_request(port, 'GET', PROBE_PATH, timeout=args.timeout)
+            except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+                status = None
+            if status == 200:
+                latencies.append(time.perf_counter() - began)
+            else:
+                errors += 1
+
+    await asyncio.gather(*[probe() for _ in range(args.probes)])
+
+    # One message fanned out to every open stream
+    sent = time.perf_counter()
+    body = {'product_id': fixture.threads[0], 'content': 'Is this still available?'}
+    try:
+        send_status = await http_request(port, 'POST', '/send_message', cookie, body, timeout=args.timeout)
+    except (OSError, asyncio.TimeoutError, IndexError, ValueError):
+        send_status = None
+    received = await asyncio.gather(*[stream.wait_message(args.timeout) for stream in streams],
+                                    return_exceptions=True)
+    delivered = [at - sent for at in received if isinstance(at, float)]
+
+    for stream in streams:
+        stream.close()
+    return {
+        'connections': connections,
+        'opened': len(streams),
+        'open_seconds': round(open_seconds, 2),
+        'probe_p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'probe_p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'probe_errors': errors,
+        'send_status': send_status,
+        'delivered': len(delivered),
+        'fanout_ms': round(max(delivered) * 1000, 1) if delivered else None,
+        'threads': threads,
+        'rss_mb': rss_mb,
+    }
+
+
+def raise_file_limit():
+    # Each held connection needs a descriptor here and in the server, which
+    # inherits this limit
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY else 65536, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def print_results(results):
+    print(f'{"server":<10} {"conns":>6} {"opened":>7} {"open s":>7} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"errors":>7} {"fanout ms":>10} {"threads":>8} {"rss MB":>8}')
+    for server, rows in results.items():
+        for row in rows:
+            def show(value):
+                return '-' if value is None else value
+            print(f'{server:<10} {row["connections"]:>6} {row["opened"]:>7} {row["open_seconds"]:>7} '
+                  f'{show(row["probe_p50_ms"]):>8} {show(row["probe_p95_ms"]):>8} {row["probe_errors"]:>7} '
+                  f'{show(row["fanout_ms"]):>10} {show(row["threads"]):>8} {show(row["rss_mb"]):>8}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent connection capacity.')
+    parser.add_argument('--db', default='bench.db', help='SQLite benchmark database, built if missing')
+    parser.add_argument('--rebuild', action='store_true', help='regenerate the database first')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=200000)
+    parser.add_argument('--messages', type=int, default=300000)
+    parser.add_argument('--servers', nargs='+', choices=SERVERS, default=SERVERS)
+    parser.add_argument('--connections', nargs='+', type=int, default=[50, 200, 1000],
+                        help='open chat streams to hold, one measurement per value')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn/uvicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='threads per gunicorn worker')
+    parser.add_argument('--probes', type=int, default=200, help='API requests made while streams are open')
+    parser.add_argument('--probe-concurrency', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds before a request counts as failed')
+    parser.add_argument('--output', help='results file (default benchmarks/<time>-<commit>-connections.json)')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(args.db)
+    os.environ.setdefault('RATELIMIT_ENABLED', '0')
+    build_database(args)
+    from app import app, db, password_hasher
+    fixture = Fixture(app, db)
+    password_hasher.shutdown()
+    file_limit = raise_file_limit()
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'workers': args.workers,
+        'gunicorn_threads': args.threads,
+        'file_limit': file_limit,
+        'results': {},
+    }
+    for name in args.servers:
+        if not available(name):
+            print(f'Skipping {name}: not installed')
+            continue
+        rows = []
+        for connections in args.connections:
+            port = free_port()
+            # A fresh server for each level, so threads left behind by the
+            # previous level do not count against this one
+            process, base_url = launch_server(server_command(name, port, args), port, dict(os.environ))
+            try:
+                cookie = login_cookie(base_url, fixture.email)
+                row = asyncio.run(measure(port, process.pid, fixture, cookie, connections, args))
+            finally:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait()
+            rows.append(row)
+            print(f'{name}: {row["opened"]}/{connections} streams open, {row["probe_errors"]} failed probes')
+        report['results'][name] = rows
+
+    print()
+    print_results(report['results'])
+    output = args.output or os.path.join(
+        'benchmarks', f'{datetime.utcnow():%Y%m%d-%H%M%S}-{commit}-connections.json'
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nSaved {output}')
+
+
+if __name__ == '__main__':
+    main()
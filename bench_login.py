@@ -0,0 +1,108 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Login throughput under concurrency. Each hashing configuration runs in its
+# own process against a throwaway database:
+#
+#     python bench_login.py --threads 32 --requests 400 --workers 0 2 4
+#
+# workers=0 hashes on the request threads, as login() used to.
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_one(args):
+    from app import app, db, init_db, password_hasher, User
+
+    with app.app_context():
+        init_db()
+        password_hash = password_hasher.hash_many(['password123'])[0]
+        db.session.add_all([
+            User(name=f'Bench User {i}', email=f'bench{i}@sampleschool.edu', password_hash=password_hash)
+            for i in range(args.users)
+        ])
+        db.session.commit()
+
+    latencies, statuses = [], {}
+    lock = threading.Lock()
+    remaining = iter(range(args.requests))
+
+    def worker():
+        client = app.test_client()
+        while True:
+            with lock:
+                i = next(remaining, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            response = client.post('/login', data={
+                'identifier': f'bench{i % args.users}@sampleschool.edu',
+                'password': 'password123',
+            })
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    password_hasher.shutdown()
+
+    print(json.dumps({
+        'hash_workers': password_hasher.workers,
+        'requests': args.requests,
+        'threads': args.threads,
+        'seconds': round(duration, 3),
+        'logins_per_second': round(statuses.get(302, 0) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'statuses': statuses,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, os.cpu_count() or 1],
+                        help='PASSWORD_HASH_WORKERS values to compare')
+    parser.add_argument('--max-pending', type=int, default=0)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_one(args)
+        return
+
+    for workers in args.workers:
+        workdir = tempfile.mkdtemp(prefix='marketplace-bench-')
+        env = dict(os.environ,
+                   DATABASE_URL='sqlite:///' + os.path.join(workdir, 'bench.db'),
+                   PASSWORD_HASH_WORKERS=str(workers),
+                   PASSWORD_HASH_MAX_PENDING=str(args.max_pending),
+                   RATELIMIT_ENABLED=os.environ.get('RATELIMIT_ENABLED', '0'))
+        subprocess.run([sys.executable, __file__, '--child',
+                        '--users', str(args.users), '--threads', str(args.threads),
+                        '--requests', str(args.requests)], env=env, check=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import threading
+import time
+
+from flask import Flask
+
+from bench_login import percentile
+from ratelimit import RateLimiter, SlidingWindow, TokenBucket, create_store
+
+# Cost of rate limiting on the allowed path. Times store.acquire() for each
+# policy, alone and from several threads at once, and a request to a limited
+# route against the same route without a limit:
+#
+#     python bench_ratelimit.py --iterations 200000 --threads 1 8
+#     python bench_ratelimit.py --store redis://localhost:6379/0
+#
+# Limits are set high enough that every call is allowed.
+
+POLICIES = {
+    'token_bucket': TokenBucket(1e9, 1e9),
+    'sliding_window': SlidingWindow(10 ** 12, 60),
+}
+
+
+def time_store(store, policy, iterations, threads, keys):
+    # Wall-clock nanoseconds per acquire() over all threads
+    per_thread = iterations // threads
+    start = threading.Barrier(threads + 1)
+
+    def worker(offset):
+        names = [f'bench:ip:10.0.{offset}.{i}' for i in range(keys)]
+        start.wait()
+        for i in range(per_thread):
+            if store.acquire(names[i % keys], policy):
+                raise RuntimeError('benchmark request was limited')
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in workers:
+        thread.join()
+    return round((time.perf_counter() - began) / (per_thread * threads) * 1e9)
+
+
+def time_requests(store, requests):
+    # Per-request latency of the same trivial view with and without a limit
+    app = Flask(__name__)
+    limiter = RateLimiter(store)
+
+    @app.route('/plain')
+    def plain():
+        return 'ok'
+
+    @app.route('/limited')
+    @limiter.limit('1000000000/second', by='ip')
+    def limited():
+        return 'ok'
+
+    client = app.test_client()
+    timings = {'/plain': [], '/limited': []}
+    # Alternate the two so drift affects both alike; the first tenth warms up
+    for i in range(requests + requests // 10):
+        for path in timings:
+            began = time.perf_counter()
+            response = client.get(path)
+            elapsed = time.perf_counter() - began
+            if response.status_code != 200:
+                raise RuntimeError(f'{path} returned {response.status_code}')
+            if i >= requests // 10:
+                timings[path].append(elapsed)
+    return {
+        'plain_p50_us': round(percentile(timings['/plain'], 0.50) * 1e6, 1),
+        'limited_p50_us': round(percentile(timings['/limited'], 0.50) * 1e6, 1),
+        'overhead_p50_us': round((percentile(timings['/limited'], 0.50)
+                                  - percentile(timings['/plain'], 0.50)) * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark rate limit overhead.')
+    parser.add_argument('--store', default='memory://', help='RATELIMIT_URL to benchmark')
+    parser.add_argument('--iterations', type=int, default=200000, help='acquire() calls per measurement')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--keys', type=int, default=1000, help='distinct clients per thread')
+    parser.add_argument('--requests', type=int, default=5000, help='test client requests per route')
+    args = parser.parse_args()
+
+    store = create_store(args.store)
+    for name, policy in POLICIES.items():
+        for threads in args.threads:
+            print(json.dumps({
+                'store': args.store,
+                'policy': name,
+                'threads': threads,
+                'ns_per_acquire': time_store(store, policy, args.iterations, threads, args.keys),
+            }))
+    print(json.dumps(dict({'store': args.store}, **time_requests(store, args.requests))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from bench_login import percentile
+
+# Route latency and throughput against a large synthetic database. Builds the
+# database with bulk_load.py (or reuses --db), then drives each route from
+# --threads concurrent clients, either through the Flask test client or over
+# HTTP against a multi-worker server:
+#
+#     python bench_routes.py --products 200000 --mode client
+#     python bench_routes.py --db bench.db --mode server --workers 4
+#     python bench_routes.py --db bench.db --compare benchmarks/<earlier run>.json
+#
+# Reports p50/p95/p99 latency, requests per second and, in client mode, SQL
+# statements per request, and saves everything as JSON under benchmarks/.
+
+ROUTES = ['index', 'index_category', 'index_search', 'index_filtered', 'index_page_2', 'index_page_10',
+          'product_detail', 'chat', 'send_message', 'login', 'my_products',
+          'api_products', 'api_products_batch']
+SEARCH_TERMS = ['lamp', 'desk', 'wireless', 'calc', 'backpack', 'monitor', 'vintage chair']
+CATEGORIES = ['Electronics', 'Books', 'Furniture', 'Clothing', 'School Supplies']
+CONDITIONS = ['New', 'Like New', 'Good', 'Fair', 'Poor']
+PRICE_RANGES = [(None, 25), (25, 50), (40, 41), (100, 250), (500, None), (4000, None)]
+SORTS = ['newest', 'price_asc', 'price_desc']
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def build_database(args):
+    if os.path.exists(args.db) and not args.rebuild:
+        return
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.abspath(args.db))
+    subprocess.run([sys.executable, 'bulk_load.py', '--reset', 'generate',
+                    '--users', str(args.users), '--products', str(args.products),
+                    '--messages', str(args.messages)], env=env, check=True)
+
+
+class Fixture:
+    # Ids the generated requests are drawn from: one benchmark user, the
+    # threads they are a buyer in, and listing cursors for deeper pages.
+
+    def __init__(self, app, db):
+        from app import Conversation, Product, User
+        with app.app_context():
+            conversation = db.session.query(Conversation).order_by(Conversation.id.desc()).first()
+            if conversation is None:
+                raise SystemExit('The benchmark database has no conversations; generate some messages')
+            user = db.session.get(User, conversation.buyer_id)
+            self.user = {'user_id': user.id, 'user_name': user.name}
+            self.email = user.email
+            self.threads = [row.product_id for row in db.session.query(Conversation.product_id)
+                            .filter_by(buyer_id=user.id).limit(100)]
+            self.max_product = db.session.query(db.func.max(Product.id)).scalar()
+            self.login_emails = [email for email, in db.session.query(User.email)
+                                 .filter(User.email.isnot(None)).limit(1000)]
+
+        client = app.test_client()
+        self.cursors = {}
+        for name, offset in (('index_page_2', 8), ('index_page_10', 72)):
+            self.cursors[name] = client.get(f'/api/products?limit={offset}').get_json()['next_cursor']
+
+    def request(self, name, rng):
+        # (method, path, form data, json body, logged in)
+        if name == 'index':
+            return 'GET', '/', None, None, False
+        if name == 'index_category':
+            return 'GET', '/?category=' + urllib.parse.quote(rng.choice(CATEGORIES)), None, None, False
+        if name == 'index_search':
+            return 'GET', '/?search=' + urllib.parse.quote(rng.choice(SEARCH_TERMS)), None, None, False
+        if name == 'index_filtered':
+            # A random mix of category, condition, price range and sort
+            min_price, max_price = rng.choice(PRICE_RANGES)
+            params = {'category': rng.choice(CATEGORIES + ['']), 'condition': rng.choice(CONDITIONS + ['']),
+                      'min_price': min_price, 'max_price': max_price, 'sort': rng.choice(SORTS)}
+            query = urllib.parse.urlencode({key: value for key, value in params.items() if value})
+            return 'GET', '/?' + query, None, None, False
+        if name in self.cursors:
+            return 'GET', f'/?cursor={self.cursors[name]}', None, None, False
+        if name == 'product_detail':
+            return 'GET', f'/product/{rng.randint(1, self.max_product)}', None, None, False
+        if name == 'chat':
+            return 'GET', f'/chat/{rng.choice(self.threads)}', None, None, True
+        if name == 'send_message':
+            body = {'product_id': rng.choice(self.threads), 'content': 'Is this still available?'}
+            return 'POST', '/send_message', None, body, True
+        if name == 'login':
+            form = {'identifier': rng.choice(self.login_emails), 'password': 'password123'}
+            return 'POST', '/login', form, None, False
+        if name == 'my_products':
+            return 'GET', '/my_products', None, None, True
+        if name == 'api_products':
+            return 'GET', '/api/v1/products?fields=id,title,price,images', None, None, False
+        if name == 'api_products_batch':
+            ids = ','.join(str(rng.randint(1, self.max_product)) for _ in range(20))
+            return 'GET', f'/api/v1/products?ids={ids}&fields=id,title,price,images', None, None, False
+        raise ValueError(f'Unknown route: {name}')
+
+
+class ClientTarget:
+    # In-process through the Flask test client, one client per thread
+    name = 'client'
+
+    def __init__(self, app, fixture):
+        self.app = app
+        self.fixture = fixture
+        self.local = threading.local()
+
+    def clients(self):
+        if not hasattr(self.local, 'clients'):
+            anonymous, logged_in = self.app.test_client(), self.app.test_client()
+            with logged_in.session_transaction() as sess:
+                sess.update(self.fixture.user)
+            self.local.clients = (anonymous, logged_in)
+        return self.local.clients
+
+    def send(self, method, path, form, body, logged_in):
+        client = self.clients()[1 if logged_in else 0]
+        return client.open(path, method=method, data=form, json=body).status_code
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPTarget:
+    # Over HTTP against a server started by start_server()
+    name = 'server'
+
+    def __init__(self, base_url, fixture):
+        self.base_url = base_url
+        self.anonymous = urllib.request.build_opener(NoRedirect)
+        jar = http.cookiejar.CookieJar()
+        self.logged_in = urllib.request.build_opener(NoRedirect, urllib.request.HTTPCookieProcessor(jar))
+        self.send('POST', '/login', {'identifier': fixture.email, 'password': 'password123'}, None, True)
+        if not jar:
+            raise SystemExit('Could not log the benchmark user in')
+
+    def send(self, method, path, form, body, logged_in):
+        headers, data = {}, None
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        opener = self.logged_in if logged_in else self.anonymous
+        try:
+            with opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def launch_server(command, port, env):
+    # In its own process group, so stopping it also stops worker and
+    # password hashing processes
+    process = subprocess.Popen(command, env=env, stderr=subprocess.DEVNULL, start_new_session=True)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(base_url + '/', timeout=5).read()
+            return process, base_url
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.1)
+    os.killpg(process.pid, signal.SIGKILL)
+    raise SystemExit('Benchmark server did not start')
+
+
+def start_server(args, env):
+    # gunicorn when installed, otherwise serve() below
+    port = free_port()
+    if shutil.which('gunicorn'):
+        command = ['gunicorn', '-w', str(args.workers), '-k', 'gthread', '--threads', '4',
+                   '-b', f'127.0.0.1:{port}', '--log-level', 'warning', 'app:app']
+        server = 'gunicorn'
+    else:
+        command = [sys.executable, __file__, '--serve', str(port), '--workers', str(args.workers)]
+        server = 'werkzeug-prefork'
+    process, base_url = launch_server(command, port, env)
+    return process, base_url, server
+
+
+def serve(args):
+    # Pre-forked threaded Werkzeug workers accepting on one shared socket,
+    # like gunicorn's gthread workers
+    from werkzeug.serving import make_server
+    from app import app
+
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', args.serve))
+    listener.listen(128)
+
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            make_server('127.0.0.1', args.serve, app, threaded=True, fd=listener.fileno()).serve_forever()
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+def run_route(target, fixture, name, args, counter=None):
+    rng = random.Random(name)
+    lock = threading.Lock()
+    for _ in range(args.warmup):
+        target.send(*fixture.request(name, rng))
+
+    requests = [fixture.request(name, rng) for _ in range(args.requests)]
+    remaining = iter(requests)
+    latencies, statuses = [], {}
+
+    def worker():
+        while True:
+            with lock:
+                request = next(remaining, None)
+            if request is None:
+                return
+            started = time.perf_counter()
+            status = target.send(*request)
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    if counter is not None:
+        counter.__enter__()
+    threads = [threading.Thread(target=worker) for _ in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - started
+    if counter is not None:
+        counter.__exit__(None, None, None)
+
+    return {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / duration, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_per_request': round(counter.count / len(latencies), 2) if counter else None,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def print_results(results, baseline=None):
+    print(f'{"route":<16} {"rps":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}  statuses')
+    for name, result in results.items():
+        queries = '-' if result['queries_per_request'] is None else result['queries_per_request']
+        line = (f'{name:<16} {result["requests_per_second"]:>8} {result["p50_ms"]:>8} '
+                f'{result["p95_ms"]:>8} {result["p99_ms"]:>8} {queries:>8}  {result["statuses"]}')
+        previous = (baseline or {}).get(name)
+        if previous:
+            change = (result['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100 if previous['p95_ms'] else 0
+            line += f'  p95 {change:+.0f}% vs {previous["p95_ms"]}'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main routes.')
+    parser.add_argument('--db', default='bench.db', help='SQLite benchmark database, built if missing')
+    parser.add_argument('--rebuild', action='store_true', help='regenerate the database first')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--products', type=int, default=200000)
+    parser.add_argument('--messages', type=int, default=300000)
+    parser.add_argument('--mode', choices=['client', 'server', 'both'], default='client')
+    parser.add_argument('--workers', type=int, default=4, help='server worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    parser.add_argument('--output', help='results file (default benchmarks/<time>-<commit>.json)')
+    parser.add_argument('--compare', help='earlier results file to compare p95 against')
+    parser.add_argument('--serve', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    database_url = 'sqlite:///' + os.path.abspath(args.db)
+    os.environ['DATABASE_URL'] = database_url
+    # Every benchmark client comes from one address
+    os.environ.setdefault('RATELIMIT_ENABLED', '0')
+    if args.serve:
+        serve(args)
+        return
+
+    build_database(args)
+
+    from app import app, db, password_hasher
+    from instrumentation import QueryCounter
+
+    fixture = Fixture(app, db)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'started_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'database': {'path': args.db, 'users': args.users, 'products': args.products,
+                     'messages': args.messages},
+        'threads': args.threads,
+        'requests_per_route': args.requests,
+        'results': {},
+    }
+
+    modes = ['client', 'server'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        server = None
+        if mode == 'client':
+            target = ClientTarget(app, fixture)
+        else:
+            server, base_url, report['server'] = start_server(args, dict(os.environ))
+            report['workers'] = args.workers
+            target = HTTPTarget(base_url, fixture)
+        try:
+            results = {}
+            for name in args.routes:
+                counter = None
+                if mode == 'client':
+                    with app.app_context():
+                        counter = QueryCounter(db.engine)
+                results[name] = run_route(target, fixture, name, args, counter)
+        finally:
+            if server is not None:
+                os.killpg(server.pid, signal.SIGTERM)
+                server.wait()
+        print(f'\n{mode} ({args.threads} threads, {args.requests} requests per route)')
+        print_results(results, (baseline or {}).get(mode))
+        report['results'][mode] = results
+
+    password_hasher.shutdown()
+    output = args.output or os.path.join(
+        'benchmarks', f'{datetime.utcnow():%Y%m%d-%H%M%S}-{commit}.json'
+    )
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nSaved {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+import argparse
+import csv
+import json
+import random
+import time
+from array import array
+from datetime import datetime, timedelta
+from itertools import islice
+
+from sqlalchemy import Boolean, DateTime, Float, Integer, func, insert, select
+
+from migrations import backfill_conversations, backfill_message_buyers
+
+# Bulk loading for benchmark databases and imports. Either generate a
+# synthetic dataset or stream users/products/messages from CSV or JSONL files
+# (chosen by extension, one object or row per record, columns named as in the
+# models):
+#
+#     python bulk_load.py --reset generate --users 100000 --products 1000000 --messages 2000000
+#     python bulk_load.py import --users users.csv --products products.jsonl
+#
+# Rows go in with executemany, --chunk-size rows per transaction. Secondary
+# indexes and the search triggers are dropped for the duration of the load and
+# rebuilt once at the end, and conversation summaries are backfilled in one
+# statement. Generated users all have the password "password123".
+
+CATEGORIES = ['Electronics', 'Books', 'Furniture', 'Clothing', 'School Supplies',
+              'Appliances', 'Accessories', 'Other']
+CONDITIONS = ['New', 'Like New', 'Good', 'Fair', 'Poor']
+ADJECTIVES = ['Used', 'Vintage', 'Compact', 'Wireless', 'Portable', 'Classic', 'Ergonomic',
+              'Lightweight', 'Refurbished', 'Durable', 'Foldable', 'Premium']
+NOUNS = ['Laptop', 'Textbook', 'Desk', 'Chair', 'Lamp', 'Calculator', 'Headphones', 'Backpack',
+         'Jacket', 'Mini Fridge', 'Monitor', 'Bike', 'Kettle', 'Notebook', 'Printer', 'Shelf']
+PHRASES = ['Works perfectly.', 'Barely used.', 'Pickup on campus only.', 'Price is negotiable.',
+           'Includes charger.', 'Some scratches.', 'Great for first years.', 'Moving out sale.',
+           'Original box included.', 'Smoke free home.']
+REPLIES = ['Is this still available?', 'Yes, it is.', 'Would you take less?', 'Can we meet tomorrow?',
+           'Sure, where on campus?', 'Outside the library at noon.', 'Deal!', 'Thanks!']
+
+TABLES = ['user', 'product', 'message']
+
+
+def chunked(rows, size):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Reading
+def read_records(path):
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as f:
+            yield from csv.DictReader(f)
+    elif path.endswith(('.jsonl', '.ndjson')):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        raise ValueError(f'Unsupported file type: {path} (use .csv or .jsonl)')
+
+
+def converter(column):
+    column_type = column.type
+    if isinstance(column_type, Boolean):
+        return lambda value: value.strip().lower() in ('1', 'true', 'yes')
+    if isinstance(column_type, Integer):
+        return int
+    if isinstance(column_type, Float):
+        return float
+    if isinstance(column_type, DateTime):
+        return datetime.fromisoformat
+    return None
+
+
+def coerce_records(table, records):
+    # CSV values are all strings and JSON has no datetimes, so convert each
+    # known column to its model type. Empty strings become NULL.
+    converters = {column.name: converter(column) for column in table.columns}
+    for record in records:
+        row = {}
+        for name, value in record.items():
+            if name == 'password':
+                row[name] = value
+                continue
+            if name not in converters:
+                continue
+            if value == '':
+                value = None
+            elif isinstance(value, str) and converters[name]:
+                value = converters[name](value)
+            if name == 'price' and value is not None:
+                # Whole cents, as the sell form stores them
+                value = round(float(value), 2)
+            row[name] = value
+        yield row
+
+
+class Loader:
+    def __init__(self, db, search_index, password_hasher, chunk_size=10000, log=print):
+        self.db = db
+        self.search_index = search_index
+        self.password_hasher = password_hasher
+        self.chunk_size = chunk_size
+        self.log = log
+        self.stats = {}
+
+    def table(self, name):
+        return self.db.metadata.tables[name]
+
+    def next_id(self, name):
+        table = self.table(name)
+        with self.db.engine.connect() as connection:
+            return (connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+    # Indexes
+    def secondary_indexes(self):
+        return [index for name in TABLES + ['conversation'] for index in self.table(name).indexes]
+
+    def drop_indexes(self):
+        started = time.perf_counter()
+        with self.db.engine.begin() as connection:
+            self.search_index.backend.drop_schema(connection)
+            for index in self.secondary_indexes():
+                index.drop(connection, checkfirst=True)
+        self.log(f'Dropped indexes and search triggers in {time.perf_counter() - started:.1f}s')
+
+    def create_indexes(self):
+        started = time.perf_counter()
+        with self.db.engine.begin() as connection:
+            for index in self.secondary_indexes():
+                index.create(connection, checkfirst=True)
+        self.log(f'Built indexes in {time.perf_counter() - started:.1f}s')
+
+        started = time.perf_counter()
+        with self.db.engine.begin() as connection:
+            # Recreates the triggers and rebuilds the index from product
+            self.search_index.backend.ensure_schema(connection)
+        self.log(f'Built search index in {time.perf_counter() - started:.1f}s')
+
+    # Loading
+    def insert(self, name, rows):
+        table = self.table(name)
+        statement = insert(table)
+        count, started = 0, time.perf_counter()
+        for chunk in chunked(rows, self.chunk_size):
+            if name == 'user':
+                self.hash_passwords(chunk)
+            # executemany needs every row to have the same keys, and imported
+            # records may leave out optional columns, so each set of keys is
+            # sent separately and columns a row lacks get their defaults
+            groups = {}
+            for row in chunk:
+                groups.setdefault(frozenset(row), []).append(row)
+            with self.db.engine.begin() as connection:
+                for group in groups.values():
+                    connection.execute(statement, group)
+            count += len(chunk)
+        elapsed = time.perf_counter() - started
+        self.stats[name] = {
+            'rows': count,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(count / elapsed) if elapsed else count,
+        }
+        self.log(f'Loaded {count} {name} rows in {elapsed:.1f}s ({self.stats[name]["rows_per_second"]} rows/s)')
+        return count
+
+    def hash_passwords(self, chunk):
+        # Imported users may carry plain passwords; each distinct one is
+        # hashed once per chunk across the hashing pool.
+        plain = sorted({row['password'] for row in chunk if 'password' in row})
+        hashes = dict(zip(plain, self.password_hasher.hash_many(plain))) if plain else {}
+        for row in chunk:
+            password = row.pop('password', None)
+            if password is not None and not row.get('password_hash'):
+                row['password_hash'] = hashes[password]
+
+    def finish(self, messages_loaded):
+        self.create_indexes()
+        if messages_loaded:
+            started = time.perf_counter()
+            with self.db.engine.begin() as connection:
+                backfill_message_buyers(connection)
+                backfill_conversations(connection)
+            self.log(f'Backfilled conversations in {time.perf_counter() - started:.1f}s')
+
+    def run(self, sources):
+        # sources: (table name, iterable of row dicts) in load order
+        started = time.perf_counter()
+        self.drop_indexes()
+        messages_loaded = False
+        try:
+            for name, rows in sources:
+                if self.insert(name, rows) and name == 'message':
+                    messages_loaded = True
+        finally:
+            self.finish(messages_loaded)
+        elapsed = time.perf_counter() - started
+        total = sum(entry['rows'] for entry in self.stats.values())
+        self.stats['total'] = {
+            'rows': total,
+            'seconds': round(elapsed, 3),
+            'rows_per_second': round(total / elapsed) if elapsed else total,
+        }
+        self.log(f'Loaded {total} rows in {elapsed:.1f}s including index builds '
+                 f'({self.stats["total"]["rows_per_second"]} rows/s)')
+        return self.stats
+
+
+# Generation
+def generate_users(count, first_id, password_hash, now):
+    for user_id in range(first_id, first_id + count):
+        yield {
+            'id': user_id,
+            'name': f'Student {user_id}',
+            'email': f'student{user_id}@sampleschool.edu',
+            'reg_number': f'H{user_id % 1000000:06d}{chr(65 + user_id // 1000000 % 26)}',
+            'password_hash': password_hash,
+            'created_at': now - timedelta(days=365),
+        }
+
+
+def without_taken_logins(loader, users, batch_size=500):
+    # Generated emails and registration numbers follow the formats people
+    # register with, so a few may already be taken. Those users are loaded
+    # without the clashing value instead of failing the load part-way.
+    table = loader.table('user')
+    cleared = 0
+    for batch in chunked(users, batch_size):
+        with loader.db.engine.connect() as connection:
+            taken = set(connection.execute(select(table.c.email).where(
+                table.c.email.in_([row['email'] for row in batch]))).scalars())
+            taken.update(connection.execute(select(table.c.reg_number).where(
+                table.c.reg_number.in_([row['reg_number'] for row in batch]))).scalars())
+        for row in batch:
+            for column in ('email', 'reg_number'):
+                if row[column] in taken:
+                    row[column] = None
+                    cleared += 1
+            yield row
+    if cleared:
+        loader.log(f'Left out {cleared} generated emails/registration numbers already in use')
+
+
+def generate_products(count, first_id, user_ids, sellers, rng, now, days):
+    for product_id in range(first_id, first_id + count):
+        seller_id = rng.randrange(*user_ids)
+        sellers.append(seller_id)
+        noun = rng.choice(NOUNS)
+        yield {
+            'id': product_id,
+            'title': f'{rng.choice(ADJECTIVES)} {noun}',
+            'description': f'{noun} for sale. ' + ' '.join(rng.sample(PHRASES, 3)),
+            'price': round(min(rng.lognormvariate(3.8, 1.0), 5000), 2),
+            'image_url': '/placeholder.svg?height=300&width=300',
+            'category': rng.choice(CATEGORIES),
+            'condition': rng.choice(CONDITIONS),
+            'seller_id': seller_id,
+            'created_at': now - timedelta(seconds=rng.randrange(days * 86400)),
+            'is_available': rng.random() < 0.9,
+        }
+
+
+def generate_messages(count, first_id, user_ids, product_ids, sellers, rng, now, days):
+    # Threads of a few messages alternating between a buyer and the seller
+    message_id, end = first_id, first_id + count
+    while message_id < end:
+        index = rng.randrange(len(sellers))
+        product_id, seller_id = product_ids[0] + index, sellers[index]
+        buyer_id = rng.randrange(*user_ids)
+        if buyer_id == seller_id:
+            continue
+        timestamp = now - timedelta(seconds=rng.randrange(days * 86400))
+        for turn in range(min(rng.randint(1, 8), end - message_id)):
+            sender_id, receiver_id = (buyer_id, seller_id) if turn % 2 == 0 else (seller_id, buyer_id)
+            timestamp += timedelta(seconds=rng.randrange(30, 3600))
+            yield {
+                'id': message_id,
+                'sender_id': sender_id,
+                'receiver_id': receiver_id,
+                'product_id': product_id,
+                'buyer_id': buyer_id,
+                'content': REPLIES[turn % len(REPLIES)],
+                'timestamp': min(timestamp, now),
+            }
+            message_id += 1
+
+
+def generate(loader, args):
+    rng = random.Random(args.seed)
+    now = datetime.utcnow()
+    first_user, first_product, first_message = (loader.next_id(name) for name in TABLES)
+    user_ids = (first_user, first_user + args.users)
+    if args.users < 2 and (args.products or args.messages):
+        raise SystemExit('generate needs at least 2 users for products and messages')
+    product_ids = (first_product, first_product + args.products)
+    # Seller of each generated product, so messages can pick valid threads
+    sellers = array('l')
+    password_hash = loader.password_hasher.hash_many(['password123'])[0]
+
+    sources = [
+        ('user', without_taken_logins(loader, generate_users(args.users, first_user, password_hash, now))),
+        ('product', generate_products(args.products, first_product, user_ids, sellers, rng, now, args.days)),
+    ]
+    if args.products:
+        # Lazily consumed after products, so `sellers` is filled by then
+        sources.append(('message', generate_messages(
+            args.messages, first_message, user_ids, product_ids, sellers, rng, now, args.days
+        )))
+    return loader.run(sources)
+
+
+def import_files(loader, args):
+    sources = []
+    for name, path in (('user', args.users), ('product', args.products), ('message', args.messages)):
+        if path:
+            sources.append((name, coerce_records(loader.table(name), read_records(path))))
+    if not sources:
+        raise SystemExit('Nothing to import: pass --users, --products and/or --messages')
+    return loader.run(sources)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load users, products and messages.')
+    parser.add_argument('--chunk-size', type=int, default=10000, help='rows per transaction')
+    parser.add_argument('--reset', action='store_true', help='drop all data before loading')
+    parser.add_argument('--json', metavar='PATH', help='also write the load statistics here')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    generate_parser = commands.add_parser('generate', help='generate a synthetic dataset')
+    generate_parser.add_argument('--users', type=int, default=10000)
+    generate_parser.add_argument('--products', type=int, default=100000)
+    generate_parser.add_argument('--messages', type=int, default=200000)
+    generate_parser.add_argument('--days', type=int, default=180, help='spread of listing dates')
+    generate_parser.add_argument('--seed', type=int, default=0)
+
+    import_parser = commands.add_parser('import', help='import CSV or JSONL files')
+    import_parser.add_argument('--users', metavar='PATH')
+    import_parser.add_argument('--products', metavar='PATH')
+    import_parser.add_argument('--messages', metavar='PATH')
+    args = parser.parse_args()
+
+    from app import app, db, init_db, password_hasher, products_changed, reset_db, search_index
+
+    with app.app_context():
+        if args.reset:
+            reset_db()
+        init_db()
+        loader = Loader(db, search_index, password_hasher, chunk_size=args.chunk_size)
+        try:
+            if args.command == 'generate':
+                stats = generate(loader, args)
+            else:
+                stats = import_files(loader, args)
+        finally:
+            password_hasher.shutdown()
+        # Core inserts bypass the ORM change tracking
+        products_changed(())
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+# Small key/value cache with pluggable backends, selected by CACHE_URL:
+#
+#     memory://?maxsize=1024     in-process LRU with per-entry TTL (default)
+#     redis://localhost:6379/0   shared Redis server (needs the redis package)
+#     local-redis://             in-process Redis stand-in, for running the
+#                                Redis code path without a server
+#
+# Values must be JSON-serialisable so every backend behaves the same.
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, default_ttl=None):
+        self.maxsize = maxsize
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.default_ttl
+        expires_at = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, json.dumps(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class MemoryRedis:
+    # The subset of the redis-py client API that RedisCache relies on
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, name):
+        expires_at = self._expires.get(name)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._data.pop(name, None)
+            self._expires.pop(name, None)
+            return True
+        return False
+
+    def get(self, name):
+        with self._lock:
+            if self._expired(name):
+                return None
+            return self._data.get(name)
+
+    def set(self, name, value, ex=None):
+        with self._lock:
+            self._data[name] = value if isinstance(value, bytes) else str(value).encode()
+            if ex:
+                self._expires[name] = time.monotonic() + ex
+            else:
+                self._expires.pop(name, None)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            removed = 0
+            for name in names:
+                removed += self._data.pop(name, None) is not None
+                self._expires.pop(name, None)
+            return removed
+
+
+class RedisCache:
+    def __init__(self, client, prefix='marketplace:', default_ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.default_ttl = default_ttl
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.default_ttl
+        self.client.set(self.prefix + key, json.dumps(value), ex=ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+def redis_client(url):
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError(f'{url} requires the redis package (pip install redis)')
+    return redis.Redis.from_url(url)
+
+
+def create_cache(url='memory://', default_ttl=None):
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        options = dict(pair.split('=', 1) for pair in parsed.query.split('&') if '=' in pair)
+        return LRUCache(int(options.get('maxsize', 1024)), default_ttl)
+    if parsed.scheme == 'local-redis':
+        return RedisCache(MemoryRedis(), default_ttl=default_ttl)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisCache(redis_client(url), default_ttl=default_ttl)
+    raise ValueError(f'Unsupported cache URL: {url}')
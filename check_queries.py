@@ -0,0 +1,173 @@
+import contextlib
+import io
+import os
+import re
+import sys
+import tempfile
+
+# Run every route against a throwaway seeded database and fail if any of them
+# issues more SQL statements than its budget allows, or if SQLite plans any
+# of its SELECTs as a scan over a whole table or index (or, for listings, as
+# a sort of every matching row). Meant for CI:
+#
+#     python check_queries.py
+#
+# A budget that grows with the number of rendered rows is an N+1 regression;
+# a SCAN in the query plan means a missing or unusable index.
+
+WORKDIR = tempfile.mkdtemp(prefix='marketplace-check-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(WORKDIR, 'check.db')
+
+from app import app, db, record_message, Product
+from instrumentation import QueryCounter
+from seed_db import seed_database
+
+BUYER = {'user_id': 2, 'user_name': 'Jane Smith'}
+SELLER = {'user_id': 1, 'user_name': 'John Doe'}
+
+def next_page(url, sort='newest'):
+    # Follow the listing's next cursor so deep pages are checked too
+    def resolve(client):
+        page = client.get(f'/api/products?limit=8&sort={sort}').get_json()
+        return url + '&cursor=' + page['next_cursor']
+    return resolve
+
+
+# (name, method, url, json body, logged in as, max statements)
+ROUTES = [
+    ('index', 'GET', '/', None, None, 3),
+    ('index_page_2', 'GET', next_page('/?category='), None, None, 2),
+    ('index_category', 'GET', '/?category=Electronics', None, None, 2),
+    ('index_search', 'GET', '/?search=calc', None, None, 2),
+    ('index_price', 'GET', '/?sort=price_asc', None, None, 2),
+    ('index_price_page_2', 'GET', next_page('/?sort=price_asc', 'price_asc'), None, None, 2),
+    ('index_filters', 'GET', '/?category=Electronics&condition=Good&min_price=10&max_price=500&sort=price_desc',
+     None, None, 2),
+    ('index_price_range', 'GET', '/?min_price=10&max_price=100', None, None, 3),
+    ('index_condition', 'GET', '/?condition=Poor', None, None, 2),
+    ('index_condition_price', 'GET', '/?condition=Poor&sort=price_asc&min_price=10&max_price=100', None, None, 2),
+    ('api_products', 'GET', '/api/products?count=1', None, None, 2),
+    ('product_detail', 'GET', '/product/1', None, None, 3),
+    ('api_v1_products', 'GET', '/api/v1/products?fields=id,title,seller&count=1', None, None, 3),
+    ('api_v1_products_batch', 'GET', '/api/v1/products?ids=3,1,2', None, None, 2),
+    ('api_v1_products_price', 'GET', '/api/v1/products?fields=id,title&sort=price_asc&max_price=100',
+     None, None, 2),
+    ('api_v1_products_condition', 'GET', '/api/v1/products?fields=id&condition=Poor', None, None, 2),
+    ('api_v1_product', 'GET', '/api/v1/products/1', None, None, 2),
+    ('api_v1_users_batch', 'GET', '/api/v1/users?ids=1,2,3', None, None, 1),
+    ('api_v1_user_products', 'GET', '/api/v1/users/1/products', None, None, 2),
+    ('api_v1_messages', 'GET', '/api/v1/messages?product_id=1', None, BUYER, 1),
+    ('api_v1_messages_batch', 'GET', '/api/v1/messages?ids=1,2,3', None, BUYER, 1),
+    ('chat', 'GET', '/chat/1', None, BUYER, 3),
+    ('chat_scrollback', 'GET', '/api/chat/1/messages?before=10&limit=5', None, BUYER, 1),
+    ('chat_catch_up', 'GET', '/api/chat/1/messages?after=10', None, BUYER, 1),
+    ('chat_seller', 'GET', '/chat/1?buyer=2', None, SELLER, 4),
+    ('send_message', 'POST', '/send_message', {'product_id': 1, 'content': 'Still available?'}, BUYER, 4),
+    ('send_reply', 'POST', '/send_message', {'product_id': 1, 'buyer_id': 2, 'content': 'Yes'}, SELLER, 5),
+    ('inbox', 'GET', '/inbox', None, SELLER, 2),
+    ('api_inbox', 'GET', '/api/inbox', None, BUYER, 2),
+    ('my_products', 'GET', '/my_products', None, SELLER, 1),
+]
+
+# Listings that must come straight off an index in sort order, so their first
+# page costs the same however many products match
+INDEX_ORDERED = {
+    'index', 'index_page_2', 'index_category', 'index_price', 'index_price_page_2', 'index_filters',
+    'index_condition', 'index_condition_price', 'api_products', 'api_v1_products', 'api_v1_products_price',
+    'api_v1_products_condition', 'inbox', 'api_inbox',
+}
+
+# Product filters that must be part of the index search rather than tested
+# on each row walked, or a value few listings have (none in the seed data
+# are Poor) makes the walk cover every listing
+INDEX_SEARCHED = {
+    'index_condition': 'condition',
+    'index_condition_price': 'condition',
+    'api_v1_products_condition': 'condition',
+}
+
+def seed():
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed_database()
+    with app.app_context():
+        product = db.session.get(Product, 1)
+        for i in range(20):
+            sender = 2 if i % 2 == 0 else 1
+            record_message(product, sender, 2, f'Message {i}')
+        db.session.commit()
+
+def run_route(client, method, url, body, user):
+    if callable(url):
+        url = url(client)
+    with client.session_transaction() as sess:
+        sess.clear()
+        if user:
+            sess.update(user)
+    with app.app_context():
+        with QueryCounter(db.engine) as counter:
+            response = client.open(url, method=method, json=body)
+    return response, counter
+
+
+SCAN_PATTERN = re.compile(r'^SCAN (\w+)')
+
+
+def scanned_tables(plan):
+    # "SCAN product_fts VIRTUAL TABLE ..." is an FTS lookup, and subqueries
+    # are named anon_N; anything else that resolves to a real table is a scan.
+    for detail in plan:
+        match = SCAN_PATTERN.match(detail)
+        if not match or 'VIRTUAL TABLE' in detail:
+            continue
+        name = re.sub(r'_\d+$', '', match.group(1))
+        if name in db.metadata.tables:
+            yield detail
+
+
+def explain(statements, index_ordered=False, searched=None):
+    problems = []
+    with app.app_context():
+        with db.engine.connect() as connection:
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith('SELECT'):
+                    continue
+                plan = [row[3] for row in connection.exec_driver_sql(
+                    'EXPLAIN QUERY PLAN ' + statement, parameters
+                )]
+                scans = list(scanned_tables(plan))
+                if index_ordered:
+                    scans += [detail for detail in plan if detail.startswith('USE TEMP B-TREE FOR ORDER BY')]
+                if searched and f'product.{searched} = ?' in statement and \
+                        not any(f'{searched}=?' in detail for detail in plan):
+                    scans.append(f'{searched} not searched')
+                if scans:
+                    problems.append((statement, plan))
+    return problems
+
+
+def main():
+    seed()
+    client = app.test_client()
+    failures = 0
+
+    for name, method, url, body, user, budget in ROUTES:
+        response, counter = run_route(client, method, url, body, user)
+        problems = explain(counter.statements, name in INDEX_ORDERED, INDEX_SEARCHED.get(name))
+        ok = response.status_code < 400 and counter.count <= budget and not problems
+        print(f'{"ok  " if ok else "FAIL"} {name:<16} {response.status_code} '
+              f'{counter.count}/{budget} queries, {len(problems)} bad plans')
+        if counter.count > budget:
+            for statement, parameters in counter.statements:
+                print(f'       {" ".join(statement.split())} {parameters}')
+        for statement, plan in problems:
+            print(f'       {" ".join(statement.split())}')
+            for detail in plan:
+                print(f'           {detail}')
+        if not ok:
+            failures += 1
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
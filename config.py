@@ -0,0 +1,120 @@
+import os
+import secrets
+import tempfile
+
+# Application settings, read from the environment once at import. See the
+# Configuration section of the README for what each one does.
+
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def database_url():
+    url = os.environ.get('DATABASE_URL', 'sqlite:///marketplace.db')
+    # Hosting platforms still hand out the scheme SQLAlchemy 1.4 dropped
+    if url.startswith('postgres://'):
+        url = 'postgresql://' + url[len('postgres://'):]
+    return url
+
+
+def load_secret_key(instance_path):
+    # Every worker process has to sign sessions with the same key. Use
+    # SECRET_KEY when set (required across several nodes); otherwise create
+    # one key per instance folder and have every later process read it.
+    key = os.environ.get('SECRET_KEY')
+    if key:
+        return key
+
+    path = os.path.join(instance_path, 'secret_key')
+    os.makedirs(instance_path, exist_ok=True)
+    if not os.path.exists(path):
+        # Write the key in full under a temporary name, then link it into
+        # place, so a process starting alongside never reads a partial file.
+        # Whichever link lands first wins.
+        fd, temp_path = tempfile.mkstemp(prefix='secret_key.', dir=instance_path)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+            os.link(temp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.unlink(temp_path)
+    with open(path) as f:
+        return f.read().strip()
+
+
+class Config:
+    SQLALCHEMY_DATABASE_URI = database_url()
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Connection pool, for server databases
+    DATABASE_POOL_SIZE = env_int('DATABASE_POOL_SIZE', 10)
+    DATABASE_MAX_OVERFLOW = env_int('DATABASE_MAX_OVERFLOW', 20)
+    DATABASE_POOL_TIMEOUT = env_int('DATABASE_POOL_TIMEOUT', 30)
+    DATABASE_POOL_RECYCLE = env_int('DATABASE_POOL_RECYCLE', 1800)
+    DATABASE_POOL_PRE_PING = env_bool('DATABASE_POOL_PRE_PING', True)
+
+    # SQLite
+    SQLITE_BUSY_TIMEOUT = env_int('SQLITE_BUSY_TIMEOUT', 5000)
+    SQLITE_MMAP_SIZE = env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    SQLITE_CACHE_SIZE = env_int('SQLITE_CACHE_SIZE', -64000)
+    SQLITE_WAL = env_bool('SQLITE_WAL', True)
+
+    # ASGI mode (asgi.py): the asyncio database URL, by default DATABASE_URL
+    # with aiosqlite, asyncpg or aiomysql, and threads for synchronous routes
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL')
+    ASGI_SYNC_THREADS = env_int('ASGI_SYNC_THREADS', 16)
+
+    # Request instrumentation, off unless INSTRUMENTATION is set
+    INSTRUMENTATION = env_bool('INSTRUMENTATION', False)
+    SLOW_QUERY_MS = env_int('SLOW_QUERY_MS', 100)
+    PROFILE_SLOW_REQUESTS_MS = env_int('PROFILE_SLOW_REQUESTS_MS', 0)
+    PROFILE_INTERVAL_MS = env_int('PROFILE_INTERVAL_MS', 5)
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+    # Relative paths are inside the instance folder
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
+    UPLOAD_MAX_BYTES = env_int('UPLOAD_MAX_BYTES', 10 * 1024 * 1024)
+    # Room for the rest of the sell form on top of the image
+    MAX_CONTENT_LENGTH = UPLOAD_MAX_BYTES + 1024 * 1024
+    MEDIA_MAX_AGE = env_int('MEDIA_MAX_AGE', 365 * 24 * 3600)
+
+    # Background jobs: "memory" runs them on threads in the web process,
+    # "database" queues them for `flask worker`
+    JOB_BACKEND = os.environ.get('JOB_BACKEND', 'memory')
+    JOB_WORKERS = env_int('JOB_WORKERS', 2)
+    JOB_MAX_ATTEMPTS = env_int('JOB_MAX_ATTEMPTS', 5)
+    JOB_LOCK_TIMEOUT = env_int('JOB_LOCK_TIMEOUT', 300)
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'auto')
+    CACHE_URL = os.environ.get('CACHE_URL', 'memory://')
+    API_COMPRESSION_MIN_BYTES = env_int('API_COMPRESSION_MIN_BYTES', 1024)
+    API_COMPRESSION_LEVEL = env_int('API_COMPRESSION_LEVEL', 5)
+    FACET_CACHE_TTL = env_int('FACET_CACHE_TTL', 300)
+    FRAGMENT_CACHE_TTL = env_int('FRAGMENT_CACHE_TTL', 3600)
+    BROKER_URL = os.environ.get('BROKER_URL', 'memory://')
+    CHAT_KEEPALIVE = env_int('CHAT_KEEPALIVE', 15)
+    CHAT_PAGE_SIZE = env_int('CHAT_PAGE_SIZE', 30)
+
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+    PASSWORD_HASH_MAX_PENDING = env_int('PASSWORD_HASH_MAX_PENDING', 0)
+    LOGIN_FAILURES_PER_IDENTIFIER = env_int('LOGIN_FAILURES_PER_IDENTIFIER', 5)
+    LOGIN_FAILURES_PER_IP = env_int('LOGIN_FAILURES_PER_IP', 20)
+    LOGIN_FAILURE_WINDOW = env_int('LOGIN_FAILURE_WINDOW', 900)
+
+    # Request rate limits (see ratelimit.py), written as '<count>/<period>'.
+    # Counts are per worker process unless RATELIMIT_URL points at Redis.
+    RATELIMIT_ENABLED = env_bool('RATELIMIT_ENABLED', True)
+    RATELIMIT_URL = os.environ.get('RATELIMIT_URL', 'memory://')
+    RATELIMIT_LOGIN = os.environ.get('RATELIMIT_LOGIN', '60/minute')
+    RATELIMIT_REGISTER = os.environ.get('RATELIMIT_REGISTER', '20/hour')
+    RATELIMIT_SEND_MESSAGE = os.environ.get('RATELIMIT_SEND_MESSAGE', '30/minute')
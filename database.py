@@ -0,0 +1,58 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+
+# Engine setup per database backend. Server databases get a tuned connection
+# pool; SQLite gets pragmas that let readers and a writer work concurrently.
+
+# Drivers for the asyncio engine used by asgi.py
+ASYNC_DRIVERS = {'sqlite': 'aiosqlite', 'postgresql': 'asyncpg', 'mysql': 'aiomysql'}
+
+
+def is_sqlite(url):
+    return make_url(url).get_backend_name() == 'sqlite'
+
+
+def async_database_url(url):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'No asyncio driver known for {backend} databases')
+    return url.set(drivername=f'{backend}+{ASYNC_DRIVERS[backend]}')
+
+
+def engine_options(config):
+    url = config['SQLALCHEMY_DATABASE_URI']
+    if is_sqlite(url):
+        return {
+            # Seconds; the busy_timeout pragma below covers later statements
+            'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000, 'check_same_thread': False},
+        }
+    return {
+        'pool_size': config['DATABASE_POOL_SIZE'],
+        'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+        'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+        'pool_recycle': config['DATABASE_POOL_RECYCLE'],
+        'pool_pre_ping': config['DATABASE_POOL_PRE_PING'],
+    }
+
+
+def configure_sqlite(engine, config):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    in_memory = engine.url.database in (None, '', ':memory:')
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # WAL lets readers carry on while a write commits; NORMAL sync is
+        # durable against application crashes and only risks the last
+        # transactions on power loss.
+        if config['SQLITE_WAL'] and not in_memory:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(config["SQLITE_BUSY_TIMEOUT"])}')
+        cursor.execute(f'PRAGMA mmap_size={int(config["SQLITE_MMAP_SIZE"])}')
+        cursor.execute(f'PRAGMA cache_size={int(config["SQLITE_CACHE_SIZE"])}')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.close()
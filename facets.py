@@ -0,0 +1,57 @@
+from sqlalchemy import case, func
+
+# Counts of available listings per category, condition and price bucket, as
+# drawn in the listing sidebar. Computed with one GROUP BY and kept in the
+# shared cache until a product change invalidates it.
+
+PRICE_BUCKETS = [(0, 25), (25, 50), (50, 100), (100, 250), (250, 500), (500, None)]
+
+
+class FacetCache:
+    key = 'facets:v1'
+
+    def __init__(self, db, model, cache, ttl=300):
+        self.db = db
+        self.model = model
+        self.cache = cache
+        self.ttl = ttl
+
+    def price_bucket(self):
+        price = self.model.price
+        whens = [(price < upper, index) for index, (lower, upper) in enumerate(PRICE_BUCKETS) if upper]
+        return case(*whens, else_=len(PRICE_BUCKETS) - 1)
+
+    def compute(self):
+        bucket = self.price_bucket().label('bucket')
+        rows = self.db.session.query(
+            self.model.category, self.model.condition, bucket, func.count()
+        ).filter_by(is_available=True).group_by(
+            self.model.category, self.model.condition, bucket
+        ).all()
+
+        categories, conditions, buckets, total = {}, {}, [0] * len(PRICE_BUCKETS), 0
+        for category, condition, bucket_index, count in rows:
+            categories[category] = categories.get(category, 0) + count
+            conditions[condition] = conditions.get(condition, 0) + count
+            buckets[bucket_index] += count
+            total += count
+
+        return {
+            'total': total,
+            'categories': [{'name': name, 'count': categories[name]} for name in sorted(categories)],
+            'conditions': [{'name': name, 'count': conditions[name]} for name in sorted(conditions)],
+            'price_buckets': [
+                {'min': lower, 'max': upper, 'count': buckets[index]}
+                for index, (lower, upper) in enumerate(PRICE_BUCKETS)
+            ],
+        }
+
+    def get(self):
+        facets = self.cache.get(self.key)
+        if facets is None:
+            facets = self.compute()
+            self.cache.set(self.key, facets, self.ttl)
+        return facets
+
+    def invalidate(self):
+        self.cache.delete(self.key)
@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing off the request thread. Hashes are computed in a process
+# pool so they spread across cores, and at most `max_pending` may be queued
+# or running at once; beyond that callers get HasherBusy straight away
+# instead of piling up behind a login storm. workers=0 hashes inline.
+
+
+class HasherBusy(Exception):
+    pass
+
+
+def pool_context():
+    # Not fork: workers forked mid-request would inherit the server's
+    # listening socket and open connections, and keep them open after the
+    # server closes them or exits
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+    return multiprocessing.get_context('spawn')
+
+
+class PasswordHasher:
+    def __init__(self, method='scrypt', workers=None, max_pending=None, timeout=10):
+        self.method = method
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending or max(self.workers, 1) * 4
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        self._method_prefix = None
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+            return self._executor
+
+    def _run(self, fn, *args):
+        if not self.workers:
+            return fn(*args)
+        if not self._slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._get_executor().submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the hash really finishes (or is cancelled
+        # before starting), not just until this caller stops waiting, so the
+        # limit tracks the work still running in the pool
+        future.add_done_callback(lambda future: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def hash_many(self, passwords):
+        # For scripts: hash a batch across every worker without the
+        # pending-request limit.
+        if not self.workers:
+            return [generate_password_hash(password, self.method) for password in passwords]
+        return list(self._get_executor().map(
+            generate_password_hash, passwords, [self.method] * len(passwords)
+        ))
+
+    @property
+    def method_prefix(self):
+        # Werkzeug fills in default parameters ("scrypt" becomes
+        # "scrypt:32768:8:1"), so read them back from a real hash once.
+        if self._method_prefix is None:
+            self._method_prefix = generate_password_hash('', self.method).split('$', 1)[0]
+        return self._method_prefix
+
+    def needs_rehash(self, pwhash):
+        return pwhash.split('$', 1)[0] != self.method_prefix
+
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,288 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from flask import Response, before_render_template, g, has_request_context, request, template_rendered
+from sqlalchemy import event
+
+
+class QueryCounter:
+    # Records every statement sent to the database while active:
+    #
+    #     with QueryCounter(db.engine) as counter:
+    #         client.get('/')
+    #     counter.count, counter.statements
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((statement, parameters))
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return False
+
+
+class RequestTiming:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_seconds = 0.0
+        self.sql_count = 0
+        self.template_seconds = 0.0
+        self._template_starts = []
+
+    def template_started(self):
+        self._template_starts.append((time.perf_counter(), self.sql_seconds))
+
+    def template_finished(self):
+        if not self._template_starts:
+            return
+        started, sql_before = self._template_starts.pop()
+        # Lazy loads fired while rendering count as SQL, not template time
+        elapsed = time.perf_counter() - started - (self.sql_seconds - sql_before)
+        if not self._template_starts:
+            self.template_seconds += elapsed
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self.started
+        self.python_seconds = max(self.total_seconds - self.sql_seconds - self.template_seconds, 0.0)
+
+    def server_timing(self):
+        return ', '.join([
+            f'sql;dur={self.sql_seconds * 1000:.1f};desc="{self.sql_count} queries"',
+            f'template;dur={self.template_seconds * 1000:.1f}',
+            f'python;dur={self.python_seconds * 1000:.1f}',
+            f'total;dur={self.total_seconds * 1000:.1f}',
+        ])
+
+
+class Metrics:
+    # Per-process counters and histograms in the Prometheus text format. With
+    # several worker processes each one reports its own numbers; scrape every
+    # worker or put them behind a sticky target.
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.durations = defaultdict(lambda: [0] * len(self.buckets))
+        self.duration_sums = Counter()
+        self.duration_counts = Counter()
+        self.seconds = Counter()
+        self.queries = Counter()
+        self.slow_queries = 0
+        # Callables returning extra exposition lines, e.g. queue depth
+        self.collectors = []
+
+    def observe(self, endpoint, method, status, timing):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            counts = self.durations[endpoint]
+            for index, bound in enumerate(self.buckets):
+                if timing.total_seconds <= bound:
+                    counts[index] += 1
+            self.duration_sums[endpoint] += timing.total_seconds
+            self.duration_counts[endpoint] += 1
+            self.seconds[(endpoint, 'sql')] += timing.sql_seconds
+            self.seconds[(endpoint, 'template')] += timing.template_seconds
+            self.seconds[(endpoint, 'python')] += timing.python_seconds
+            self.queries[endpoint] += timing.sql_count
+
+    def slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines += ['# HELP http_requests_total Requests handled, by endpoint, method and status.',
+                      '# TYPE http_requests_total counter']
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{endpoint}",method="{method}",'
+                             f'status="{status}"}} {count}')
+
+            lines += ['# HELP http_request_duration_seconds Request duration, by endpoint.',
+                      '# TYPE http_request_duration_seconds histogram']
+            for endpoint, counts in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+                total = self.duration_counts[endpoint]
+                lines.append(f'http_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {total}')
+                lines.append(f'http_request_duration_seconds_sum{{endpoint="{endpoint}"}} {self.duration_sums[endpoint]:.6f}')
+                lines.append(f'http_request_duration_seconds_count{{endpoint="{endpoint}"}} {total}')
+
+            lines += ['# HELP http_request_phase_seconds_total Time spent in SQL, templates and Python.',
+                      '# TYPE http_request_phase_seconds_total counter']
+            for (endpoint, phase), seconds in sorted(self.seconds.items()):
+                lines.append(f'http_request_phase_seconds_total{{endpoint="{endpoint}",phase="{phase}"}} {seconds:.6f}')
+
+            lines += ['# HELP sql_queries_total SQL statements executed, by endpoint.',
+                      '# TYPE sql_queries_total counter']
+            for endpoint, count in sorted(self.queries.items()):
+                lines.append(f'sql_queries_total{{endpoint="{endpoint}"}} {count}')
+
+            lines += ['# HELP sql_slow_queries_total Statements slower than SLOW_QUERY_MS.',
+                      '# TYPE sql_slow_queries_total counter',
+                      f'sql_slow_queries_total {self.slow_queries}']
+        for collector in self.collectors:
+            lines += collector()
+        return '\n'.join(lines) + '\n'
+
+
+def folded_stack(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    # One background thread samples the stacks of the threads currently
+    # serving requests every `interval` seconds. Samples are kept as folded
+    # stacks ("a;b;c count"), the input format of flamegraph.pl and speedscope.
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, samples in active:
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[folded_stack(frame)] += 1
+
+    def start(self):
+        with self._lock:
+            self._active[threading.get_ident()] = Counter()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            return self._active.pop(threading.get_ident(), None)
+
+
+class Instrumentation:
+    # Opt-in (INSTRUMENTATION=1) request instrumentation:
+    #
+    #  - SQL, template and remaining Python time per request, sent back in a
+    #    Server-Timing header (visible in the browser's network panel)
+    #  - statements slower than slow_query_ms logged with their parameters
+    #  - Prometheus metrics at /metrics
+    #  - with profile_threshold_ms set, requests slower than that dump their
+    #    sampled stacks to profile_dir
+
+    def __init__(self, app, engine, slow_query_ms=100, profile_threshold_ms=0,
+                 profile_interval_ms=5, profile_dir='profiles'):
+        self.app = app
+        self.slow_query_seconds = slow_query_ms / 1000
+        self.profile_threshold_seconds = profile_threshold_ms / 1000
+        self.profile_dir = profile_dir
+        self.profiler = SamplingProfiler(profile_interval_ms / 1000) if profile_threshold_ms else None
+        self.metrics = Metrics()
+
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        before_render_template.connect(self._template_started, app)
+        template_rendered.connect(self._template_finished, app)
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+
+    def _timing(self):
+        if has_request_context():
+            return g.get('request_timing')
+        return None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        timing = self._timing()
+        if timing is not None:
+            timing.sql_seconds += elapsed
+            timing.sql_count += 1
+        if elapsed >= self.slow_query_seconds:
+            self.metrics.slow_query()
+            where = f' in {request.method} {request.path}' if has_request_context() else ''
+            self.app.logger.warning(f'Slow query ({elapsed * 1000:.1f}ms){where}: '
+                                    f'{" ".join(statement.split())} {parameters!r}')
+
+    def _template_started(self, sender, template, context, **extra):
+        timing = self._timing()
+        if timing is not None:
+            timing.template_started()
+
+    def _template_finished(self, sender, template, context, **extra):
+        timing = self._timing()
+        if timing is not None:
+            timing.template_finished()
+
+    def _before_request(self):
+        g.request_timing = RequestTiming()
+        if self.profiler:
+            self.profiler.start()
+
+    def _after_request(self, response):
+        timing = g.pop('request_timing', None)
+        if timing is None:
+            return response
+        timing.finish()
+        endpoint = request.endpoint or 'unmatched'
+        response.headers['Server-Timing'] = timing.server_timing()
+        if endpoint != 'metrics':
+            self.metrics.observe(endpoint, request.method, response.status_code, timing)
+        if self.profiler:
+            samples = self.profiler.stop()
+            if samples and timing.total_seconds >= self.profile_threshold_seconds:
+                self.dump_profile(endpoint, timing, samples)
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request is skipped when a request fails outright
+        if self.profiler:
+            self.profiler.stop()
+
+    def dump_profile(self, endpoint, timing, samples):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(
+            self.profile_dir,
+            f'{datetime.utcnow():%Y%m%d-%H%M%S-%f}-{endpoint}-{timing.total_seconds * 1000:.0f}ms.folded'
+        )
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        self.app.logger.warning(f'Slow request {request.method} {request.path} took '
+                                f'{timing.total_seconds * 1000:.0f}ms; profile written to {path}')
+
+    def metrics_view(self):
+        return Response(self.metrics.render(), mimetype='text/plain; version=0.0.4')
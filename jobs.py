@@ -0,0 +1,308 @@
+import importlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, func, or_, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+# Background jobs for side effects that should not hold up a request.
+# Handlers are registered by name and take a JSON-serialisable payload:
+#
+#     @jobs.task('generate_thumbnails')
+#     def generate_thumbnails(payload): ...
+#
+#     jobs.enqueue('generate_thumbnails', {'digest': digest}, key=f'thumbnails:{digest}')
+#
+# Jobs are enqueued inside the caller's transaction and only become visible
+# once it commits, so a rolled-back request never leaves work behind. With
+# JOB_BACKEND=database they are rows in the job table, processed by
+# `flask --app app worker` (run as many as needed); with JOB_BACKEND=memory
+# they run on a thread pool in the web process, which needs no worker but
+# loses queued jobs on restart. An idempotency key makes enqueueing the same
+# work twice a no-op. Failed jobs are retried with exponential backoff.
+
+BACKENDS = ('database', 'memory')
+
+
+def backoff(attempt, base=5, cap=3600):
+    # 5s, 10s, 20s, ... with jitter so failed jobs do not retry in lockstep
+    delay = min(cap, base * 2 ** (attempt - 1))
+    return delay * random.uniform(0.8, 1.2)
+
+
+class JobQueue:
+    def __init__(self, app, db, model, backend='memory', workers=2, max_attempts=5,
+                 lock_timeout=300, log=print):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unsupported job backend: {backend}')
+        self.app = app
+        self.db = db
+        self.model = model
+        self.backend = backend
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lock_timeout = lock_timeout
+        self.log = log
+        self.handlers = {}
+
+        # In-process state for the memory backend
+        self._executor = None
+        self._lock = threading.Lock()
+        self._keys = OrderedDict()
+        self._stats = Counter()
+        self._timings = Counter()
+
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_soft_rollback', self._after_rollback)
+
+    def task(self, name):
+        def decorator(fn):
+            self.handlers[name] = fn
+            return fn
+        return decorator
+
+    # Enqueueing
+    def enqueue(self, name, payload=None, key=None, delay=0, max_attempts=None):
+        if name not in self.handlers:
+            raise LookupError(f'No handler for job {name!r}')
+        job = {
+            'name': name,
+            'payload': payload or {},
+            'key': key,
+            'run_at': datetime.utcnow() + timedelta(seconds=delay),
+            'max_attempts': max_attempts or self.max_attempts,
+        }
+        if self.backend == 'memory':
+            self.db.session.info.setdefault('pending_jobs', []).append(job)
+            return
+
+        values = {
+            'name': name, 'payload': json.dumps(job['payload']), 'idempotency_key': key,
+            'run_at': job['run_at'], 'max_attempts': job['max_attempts'],
+        }
+        session = self.db.session
+        dialect = session.get_bind().dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            # pysqlite does not BEGIN before a SAVEPOINT, so a savepoint there
+            # would commit on release; ON CONFLICT keeps the insert inside the
+            # caller's transaction
+            insert = importlib.import_module(f'sqlalchemy.dialects.{dialect}').insert
+            session.execute(insert(self.model).values(**values).on_conflict_do_nothing(
+                index_elements=['idempotency_key']
+            ))
+            return
+        try:
+            # A duplicate key only rolls back this savepoint
+            with session.begin_nested():
+                session.add(self.model(**values))
+        except IntegrityError:
+            pass
+
+    def _after_commit(self, session):
+        pending = session.info.pop('pending_jobs', None)
+        for job in pending or ():
+            self._submit_local(job)
+
+    def _after_rollback(self, session, previous_transaction):
+        session.info.pop('pending_jobs', None)
+
+    # Memory backend
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='jobs')
+            return self._executor
+
+    def _submit_local(self, job, attempt=1):
+        with self._lock:
+            if attempt == 1 and job['key']:
+                if job['key'] in self._keys:
+                    return
+                self._keys[job['key']] = True
+                while len(self._keys) > 10000:
+                    self._keys.popitem(last=False)
+            self._stats['queued'] += 1
+        job['enqueued'] = time.monotonic()
+        delay = (job['run_at'] - datetime.utcnow()).total_seconds() if attempt == 1 else 0
+        if delay > 0:
+            timer = threading.Timer(delay, self._get_executor().submit, (self._run_local, job, attempt))
+            timer.daemon = True
+            timer.start()
+        else:
+            self._get_executor().submit(self._run_local, job, attempt)
+
+    def _run_local(self, job, attempt):
+        started = time.monotonic()
+        with self._lock:
+            self._stats['queued'] -= 1
+            self._stats['running'] += 1
+            self._timings['wait_seconds'] += started - job['enqueued']
+        try:
+            self.run_handler(job['name'], job['payload'])
+            outcome = 'done'
+        except Exception as e:
+            outcome = 'retried' if attempt < job['max_attempts'] else 'failed'
+            self.log(f'Job {job["name"]} attempt {attempt} failed: {e}')
+        with self._lock:
+            self._stats['running'] -= 1
+            self._stats[outcome] += 1
+            self._timings['run_seconds'] += time.monotonic() - started
+            self._timings['finished'] += 1
+        if outcome == 'retried':
+            timer = threading.Timer(backoff(attempt), self._submit_local, (job, attempt + 1))
+            timer.daemon = True
+            timer.start()
+
+    def run_handler(self, name, payload):
+        with self.app.app_context():
+            try:
+                self.handlers[name](payload)
+            finally:
+                self.db.session.remove()
+
+    # Database backend
+    def claim(self, worker_id):
+        # Optimistic claim that works without SELECT ... FOR UPDATE SKIP
+        # LOCKED: pick ready candidates, then flip one from queued to running
+        # only if no other worker got there first. Jobs left running by a
+        # crashed worker become claimable again after lock_timeout.
+        Job = self.model
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=self.lock_timeout)
+        claimable = or_(
+            (Job.status == 'queued') & (Job.run_at <= now),
+            (Job.status == 'running') & (Job.locked_at < stale),
+        )
+        with self.db.engine.begin() as connection:
+            candidates = connection.execute(
+                select(Job.id, Job.status).where(claimable).order_by(Job.run_at, Job.id).limit(10)
+            ).all()
+            for job_id, status in candidates:
+                claimed = connection.execute(
+                    update(Job).where(Job.id == job_id, Job.status == status, claimable).values(
+                        status='running', locked_by=worker_id, locked_at=now,
+                        started_at=now, attempts=Job.attempts + 1
+                    )
+                )
+                if claimed.rowcount == 1:
+                    return connection.execute(select(Job.__table__).where(Job.id == job_id)).one()
+        return None
+
+    def finish(self, job, error=None):
+        Job = self.model
+        now = datetime.utcnow()
+        if error is None:
+            values = {'status': 'done', 'finished_at': now, 'last_error': None}
+        elif job.attempts < job.max_attempts:
+            values = {'status': 'queued', 'run_at': now + timedelta(seconds=backoff(job.attempts)),
+                      'last_error': error}
+        else:
+            values = {'status': 'failed', 'finished_at': now, 'last_error': error}
+        with self.db.engine.begin() as connection:
+            connection.execute(update(Job).where(Job.id == job.id).values(locked_by=None, **values))
+        return values['status']
+
+    def work(self, burst=False, poll_interval=1.0, retention=7 * 24 * 3600, log=None):
+        log = log or self.log
+        worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        log(f'Worker {worker_id} processing jobs')
+        last_purge = 0
+        while True:
+            try:
+                job = self.claim(worker_id)
+            except OperationalError as e:
+                # SQLite reports lock contention with other workers as errors
+                log(f'Could not claim a job: {e}')
+                time.sleep(poll_interval)
+                continue
+            if job is None:
+                if burst:
+                    return
+                if time.monotonic() - last_purge > 3600:
+                    self.purge(retention)
+                    last_purge = time.monotonic()
+                time.sleep(poll_interval)
+                continue
+
+            error = None
+            try:
+                if job.name not in self.handlers:
+                    raise LookupError(f'No handler for job {job.name!r}')
+                self.run_handler(job.name, json.loads(job.payload))
+            except Exception:
+                error = traceback.format_exc(limit=5)
+            status = self.finish(job, error)
+            log(f'Job {job.id} {job.name} attempt {job.attempts}: {status}')
+
+    def purge(self, retention):
+        Job = self.model
+        cutoff = datetime.utcnow() - timedelta(seconds=retention)
+        with self.db.engine.begin() as connection:
+            connection.execute(Job.__table__.delete().where(Job.status == 'done', Job.finished_at < cutoff))
+
+    # Metrics
+    def stats(self):
+        if self.backend == 'memory':
+            with self._lock:
+                finished = self._timings['finished']
+                return {
+                    'depth': {status: self._stats[status] for status in ('queued', 'running')},
+                    'processed': {status: self._stats[status] for status in ('done', 'retried', 'failed')},
+                    'oldest_ready_seconds': None,
+                    'avg_wait_seconds': self._timings['wait_seconds'] / finished if finished else 0.0,
+                    'avg_run_seconds': self._timings['run_seconds'] / finished if finished else 0.0,
+                }
+
+        Job = self.model
+        now = datetime.utcnow()
+        recent = now - timedelta(minutes=15)
+        session = self.db.session
+        depth = dict(session.query(Job.status, func.count()).group_by(Job.status).all())
+        oldest = session.query(func.min(Job.run_at)).filter(Job.status == 'queued', Job.run_at <= now).scalar()
+        finished = session.query(Job.created_at, Job.started_at, Job.finished_at).filter(
+            Job.status == 'done', Job.finished_at >= recent
+        ).all()
+        waits = [(started - created).total_seconds() for created, started, done in finished]
+        runs = [(done - started).total_seconds() for created, started, done in finished]
+        return {
+            'depth': {status: depth.get(status, 0) for status in ('queued', 'running', 'done', 'failed')},
+            'oldest_ready_seconds': (now - oldest).total_seconds() if oldest else 0.0,
+            'avg_wait_seconds': sum(waits) / len(waits) if waits else 0.0,
+            'avg_run_seconds': sum(runs) / len(runs) if runs else 0.0,
+        }
+
+    def prometheus_lines(self):
+        stats = self.stats()
+        lines = ['# HELP jobs Jobs by status.', '# TYPE jobs gauge']
+        for status, count in sorted(stats['depth'].items()):
+            lines.append(f'jobs{{backend="{self.backend}",status="{status}"}} {count}')
+        if 'processed' in stats:
+            lines += ['# HELP jobs_processed_total Jobs run in this process, by outcome.',
+                      '# TYPE jobs_processed_total counter']
+            for outcome, count in sorted(stats['processed'].items()):
+                lines.append(f'jobs_processed_total{{outcome="{outcome}"}} {count}')
+        if stats['oldest_ready_seconds'] is not None:
+            lines += ['# HELP jobs_oldest_ready_seconds Age of the oldest job waiting to run.',
+                      '# TYPE jobs_oldest_ready_seconds gauge',
+                      f'jobs_oldest_ready_seconds {stats["oldest_ready_seconds"]:.3f}']
+        lines += ['# HELP jobs_wait_seconds Average time from enqueue to start.',
+                  '# TYPE jobs_wait_seconds gauge',
+                  f'jobs_wait_seconds {stats["avg_wait_seconds"]:.3f}',
+                  '# HELP jobs_run_seconds Average handler run time.',
+                  '# TYPE jobs_run_seconds gauge',
+                  f'jobs_run_seconds {stats["avg_run_seconds"]:.3f}']
+        return lines
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
@@ -0,0 +1,151 @@
+import hashlib
+import os
+import re
+import tempfile
+
+# Uploaded product images. Uploads are copied to disk in chunks while being
+# hashed and stored under their SHA-256, so the same photo uploaded twice is
+# kept once. Grid and detail thumbnails are rendered as WebP and JPEG by a
+# background job; their URLs contain the content hash, so they can be cached
+# by browsers forever. Originals are never served, since they may carry EXIF
+# location data.
+#
+#     <root>/originals/ab/ab12...ef
+#     <root>/thumbs/grid/ab/ab12...ef.webp
+
+THUMBNAIL_SIZES = {'grid': (400, 400), 'detail': (1200, 1200)}
+THUMBNAIL_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpg': ('JPEG', 'image/jpeg')}
+ACCEPTED_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+MAX_PIXELS = 40_000_000
+CHUNK_SIZE = 64 * 1024
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+
+class UploadError(ValueError):
+    pass
+
+
+def pillow():
+    try:
+        from PIL import Image, ImageOps, UnidentifiedImageError
+    except ImportError:
+        raise RuntimeError('Image uploads require Pillow (pip install Pillow)')
+    return Image, ImageOps, UnidentifiedImageError
+
+
+def write_atomically(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def render_thumbnails(original, outputs):
+    # outputs: [(path, (width, height), format)]
+    Image, ImageOps, _ = pillow()
+    with Image.open(original) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for path, size, image_format in outputs:
+            thumbnail = image.copy()
+            thumbnail.thumbnail(size, Image.LANCZOS)
+            if image_format == 'JPEG' and thumbnail.mode != 'RGB':
+                thumbnail = thumbnail.convert('RGB')
+            write_atomically(path, lambda f: thumbnail.save(f, image_format, quality=80, optimize=True))
+
+
+class MediaStore:
+    def __init__(self, root, max_bytes=10 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def original_path(self, digest):
+        return os.path.join(self.root, 'originals', digest[:2], digest)
+
+    def thumbnail_path(self, size, digest, extension):
+        return os.path.join(self.root, 'thumbs', size, digest[:2], f'{digest}.{extension}')
+
+    def save(self, file):
+        # Returns the content hash of an uploaded FileStorage
+        tmp_dir = os.path.join(self.root, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            digest = hashlib.sha256()
+            size = 0
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = file.stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadError(f'Images can be at most {self.max_bytes // (1024 * 1024)} MB.')
+                    digest.update(chunk)
+                    out.write(chunk)
+            self.validate(tmp_path)
+
+            digest = digest.hexdigest()
+            path = self.original_path(digest)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return digest
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def validate(self, path):
+        # Only reads the header; decoding happens in the thumbnail job
+        Image, _, UnidentifiedImageError = pillow()
+        try:
+            with Image.open(path) as image:
+                image_format, (width, height) = image.format, image.size
+        except (UnidentifiedImageError, OSError):
+            raise UploadError('Please upload a JPEG, PNG, WebP or GIF image.')
+        if image_format not in ACCEPTED_FORMATS:
+            raise UploadError('Please upload a JPEG, PNG, WebP or GIF image.')
+        if width * height > MAX_PIXELS:
+            raise UploadError('That image has too many pixels; please resize it first.')
+
+    def missing_thumbnails(self, digest, sizes=THUMBNAIL_SIZES):
+        return [
+            (self.thumbnail_path(size, digest, extension), dimensions, image_format)
+            for size, dimensions in sizes.items()
+            for extension, (image_format, mimetype) in THUMBNAIL_FORMATS.items()
+            if not os.path.exists(self.thumbnail_path(size, digest, extension))
+        ]
+
+    def create_thumbnails(self, digest):
+        # Safe to repeat: only missing thumbnails are rendered. /media renders
+        # on demand if a thumbnail is requested before this has run.
+        outputs = self.missing_thumbnails(digest)
+        if outputs:
+            render_thumbnails(self.original_path(digest), outputs)
+
+    def thumbnail(self, size, digest, extension):
+        # Path to an existing thumbnail, rendering it first if needed.
+        # Raises LookupError for anything that is not a stored image.
+        if size not in THUMBNAIL_SIZES or extension not in THUMBNAIL_FORMATS:
+            raise LookupError(size)
+        if not DIGEST_PATTERN.match(digest) or not os.path.exists(self.original_path(digest)):
+            raise LookupError(digest)
+        path = self.thumbnail_path(size, digest, extension)
+        if not os.path.exists(path):
+            render_thumbnails(self.original_path(digest), [
+                (path, THUMBNAIL_SIZES[size], THUMBNAIL_FORMATS[extension][0])
+            ])
+        return path
+
+    @staticmethod
+    def mimetype(extension):
+        return THUMBNAIL_FORMATS[extension][1]
@@ -0,0 +1,201 @@
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, Numeric, String, Table, cast, func, inspect, select, text, update
+
+# Versioned schema migrations. Each migration runs once, in order, inside its
+# own transaction and is recorded in the schema_migrations table. Migrations
+# must be idempotent: a brand new database gets the current models from the
+# initial create, so later steps have to cope with objects that already exist.
+
+version_metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return fn
+    return decorator
+
+
+# Helpers
+def create_tables(connection, metadata, *names):
+    for name in names:
+        metadata.tables[name].create(connection, checkfirst=True)
+
+
+def create_indexes(connection, metadata, table_name, *index_names):
+    table = metadata.tables[table_name]
+    for index in table.indexes:
+        if index.name in index_names:
+            index.create(connection, checkfirst=True)
+
+
+def add_column(connection, metadata, table_name, column_name):
+    existing = {column['name'] for column in inspect(connection).get_columns(table_name)}
+    if column_name in existing:
+        return
+    column = metadata.tables[table_name].c[column_name]
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}')
+
+
+class Migrator:
+    def __init__(self, db, search_index):
+        self.db = db
+        self.search_index = search_index
+
+    @property
+    def metadata(self):
+        return self.db.metadata
+
+    def applied_versions(self, connection):
+        return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+    def current_version(self):
+        with self.db.engine.begin() as connection:
+            schema_migrations.create(connection, checkfirst=True)
+            return max(self.applied_versions(connection), default=0)
+
+    def upgrade(self, log=None):
+        with self.db.engine.begin() as connection:
+            schema_migrations.create(connection, checkfirst=True)
+            applied = self.applied_versions(connection)
+
+        for version, name, fn in MIGRATIONS:
+            if version in applied:
+                continue
+            with self.db.engine.begin() as connection:
+                fn(self, connection)
+                connection.execute(schema_migrations.insert().values(
+                    version=version, name=name, applied_at=datetime.utcnow()
+                ))
+            if log:
+                log(f'Applied migration {version:04d} {name}')
+
+    def reset(self):
+        self.search_index.drop_schema()
+        self.db.drop_all()
+        with self.db.engine.begin() as connection:
+            schema_migrations.drop(connection, checkfirst=True)
+
+
+def backfill_message_buyers(connection):
+    # The buyer is whichever participant is not the product's seller
+    connection.execute(text('''
+        UPDATE message SET buyer_id = CASE
+            WHEN sender_id = (SELECT seller_id FROM product WHERE product.id = message.product_id)
+            THEN receiver_id ELSE sender_id END
+        WHERE buyer_id IS NULL
+    '''))
+
+
+def backfill_conversations(connection):
+    # One conversation per (product, buyer) thread that has messages but no
+    # summary row yet, pointing at its latest message. Unread counts start at
+    # zero since there is no record of what was already read.
+    connection.execute(text('''
+        INSERT INTO conversation (
+            product_id, buyer_id, seller_id, last_message_id, last_sender_id,
+            last_message_preview, last_message_at, buyer_unread, seller_unread, created_at
+        )
+        SELECT m.product_id, m.buyer_id, p.seller_id, m.id, m.sender_id,
+               substr(m.content, 1, 200), m.timestamp, 0, 0,
+               (SELECT min(first.timestamp) FROM message AS first
+                WHERE first.product_id = m.product_id AND first.buyer_id = m.buyer_id)
+        FROM message AS m
+        JOIN product AS p ON p.id = m.product_id
+        WHERE m.buyer_id IS NOT NULL
+          AND m.id = (SELECT max(latest.id) FROM message AS latest
+                      WHERE latest.product_id = m.product_id AND latest.buyer_id = m.buyer_id)
+          AND NOT EXISTS (SELECT 1 FROM conversation AS c
+                          WHERE c.product_id = m.product_id AND c.buyer_id = m.buyer_id)
+    '''))
+
+
+# Migrations
+@migration(1, 'initial schema')
+def initial_schema(migrator, connection):
+    create_tables(connection, migrator.metadata, 'user', 'product', 'message')
+
+
+@migration(2, 'product search index')
+def product_search_index(migrator, connection):
+    migrator.search_index.backend.ensure_schema(connection)
+
+
+@migration(3, 'listing and chat indexes')
+def listing_and_chat_indexes(migrator, connection):
+    create_indexes(connection, migrator.metadata, 'product',
+                   'ix_product_available_created',
+                   'ix_product_available_category_created',
+                   'ix_product_seller_created')
+    # ix_message_conversation was replaced by ix_message_thread in 0004
+    create_indexes(connection, migrator.metadata, 'message',
+                   'ix_message_conversation')
+
+
+@migration(4, 'message thread index')
+def message_thread_index(migrator, connection):
+    add_column(connection, migrator.metadata, 'message', 'buyer_id')
+    backfill_message_buyers(connection)
+    connection.execute(text('DROP INDEX IF EXISTS ix_message_conversation'))
+    create_indexes(connection, migrator.metadata, 'message', 'ix_message_thread')
+
+
+@migration(5, 'conversation summaries')
+def conversation_summaries(migrator, connection):
+    create_tables(connection, migrator.metadata, 'conversation')
+    backfill_conversations(connection)
+
+
+@migration(6, 'product updated_at')
+def product_updated_at(migrator, connection):
+    add_column(connection, migrator.metadata, 'product', 'updated_at')
+    connection.execute(text('UPDATE product SET updated_at = created_at WHERE updated_at IS NULL'))
+
+
+@migration(7, 'product image hash')
+def product_image_hash(migrator, connection):
+    add_column(connection, migrator.metadata, 'product', 'image_hash')
+
+
+@migration(8, 'job queue')
+def job_queue(migrator, connection):
+    create_tables(connection, migrator.metadata, 'job')
+
+
+@migration(9, 'price browse indexes')
+def price_browse_indexes(migrator, connection):
+    create_indexes(connection, migrator.metadata, 'product',
+                   'ix_product_available_price',
+                   'ix_product_available_category_price')
+
+
+@migration(10, 'round prices to cents')
+def round_prices(migrator, connection):
+    # The price filters and facet buckets assume whole cents
+    product = migrator.metadata.tables['product']
+    rounded = func.round(cast(product.c.price, Numeric(18, 6)), 2)
+    connection.execute(update(product).where(product.c.price != rounded).values(price=rounded))
+
+
+@migration(11, 'product updated index')
+def product_updated_index(migrator, connection):
+    create_indexes(connection, migrator.metadata, 'product', 'ix_product_updated')
+
+
+@migration(12, 'condition browse indexes')
+def condition_browse_indexes(migrator, connection):
+    create_indexes(connection, migrator.metadata, 'product',
+                   'ix_product_available_condition_created',
+                   'ix_product_available_condition_price')
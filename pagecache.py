@@ -0,0 +1,82 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from markupsafe import Markup
+from sqlalchemy import func, select
+
+# Versions and rendered HTML for the public catalogue pages. The catalogue
+# version changes on every product write and drives the ETag/Last-Modified
+# headers; each product also has its own version so one edit does not throw
+# away every other product's fragments. Fragments live in the shared cache.
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def template_fingerprint(app):
+    # Part of every ETag and fragment key, so HTML rendered by an older
+    # deploy's templates is never served again
+    digest = hashlib.sha1()
+    folder = os.path.join(app.root_path, app.template_folder)
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, folder).encode())
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+class CatalogVersion:
+    # Read from the product rows themselves, so every worker computes the
+    # same version and nothing has to be kept in sync: the newest updated_at
+    # (ix_product_updated) and the highest id, two index lookups. A listing
+    # that is deleted without being the newest or last changed one goes
+    # unnoticed; listings are taken down by marking them unavailable.
+
+    def __init__(self, db, model):
+        self.db = db
+        self.model = model
+
+    def current(self, db_session=None):
+        db_session = db_session or self.db.session
+        model = self.model
+        # Separate subqueries, so each max() is a single index lookup
+        updated_at, last_id = db_session.execute(select(
+            select(func.max(model.updated_at)).scalar_subquery(),
+            select(func.max(model.id)).scalar_subquery(),
+        )).one()
+        modified = (updated_at or EPOCH).replace(tzinfo=timezone.utc)
+        return {'tag': f'{int(modified.timestamp() * 1e6):x}-{last_id or 0:x}', 'modified': modified}
+
+    def product(self, product_id, db_session=None):
+        # The product's own version, or None when it does not exist
+        db_session = db_session or self.db.session
+        updated_at = db_session.execute(
+            select(self.model.updated_at).where(self.model.id == product_id)
+        ).scalar()
+        return updated_at.isoformat() if updated_at else None
+
+
+class FragmentCache:
+    def __init__(self, cache, fingerprint, ttl=3600):
+        self.cache = cache
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+
+    def key(self, *parts):
+        return ':'.join(['fragment', self.fingerprint] + [str(part) for part in parts])
+
+    def get(self, *parts):
+        return self.cache.get(self.key(*parts))
+
+    def set(self, value, *parts):
+        self.cache.set(self.key(*parts), value, self.ttl)
+
+    def render(self, render, *parts):
+        html = self.get(*parts)
+        if html is None:
+            html = str(render())
+            self.set(html, *parts)
+        return Markup(html)
@@ -0,0 +1,126 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import select, tuple_, union_all
+
+# Keyset (cursor) pagination. Instead of OFFSET, each page continues from
+# the sort key of the last row it returned, so page 500 costs the same as
+# page 1 as long as an index matches the sort columns. Cursors are opaque
+# url-safe tokens carrying the direction and the boundary key, and the name
+# of the sort order when a query can be sorted more than one way.
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _dump_value(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _load_value(value):
+    if isinstance(value, dict) and 'dt' in value:
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(direction, key, order=None):
+    payload = {'d': direction, 'k': [_dump_value(value) for value in key]}
+    if order is not None:
+        payload['o'] = order
+    payload = json.dumps(payload, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor, key_length, order=None):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        direction = payload['d']
+        key = tuple(_load_value(value) for value in payload['k'])
+        cursor_order = payload.get('o')
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+    if direction not in ('next', 'prev') or len(key) != key_length or cursor_order != order:
+        raise InvalidCursor(cursor)
+    return direction, key
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def keyset_paginate(query, columns, key, cursor=None, per_page=8, descending=True,
+                    item=None, count=False, order=None, union=None):
+    # `columns` are the SQL sort expressions (the last one must be unique,
+    # normally the primary key) and `key(row)` returns the same values for a
+    # fetched row. `item(row)` maps fetched rows to the returned items.
+    # Cursors made for a different `order` name are rejected.
+    #
+    # `union` pages over rows matching any of several lists of criteria,
+    # where an OR of them would stop the database reading an index in order.
+    # Each list is read in order on its own and merged with UNION ALL to find
+    # the page's keys, then `query` loads those rows by the last column.
+    # The lists must not overlap.
+    if not count:
+        total = None
+    elif union is None:
+        total = query.order_by(None).count()
+    else:
+        total = sum(query.filter(*criteria).order_by(None).count() for criteria in union)
+
+    direction, boundary = 'next', None
+    if cursor:
+        direction, boundary = decode_cursor(cursor, len(columns), order)
+
+    # Walking backwards means flipping both the comparison and the sort order,
+    # then reversing the fetched rows back into display order.
+    forward = direction == 'next'
+    newest_first = descending == forward
+    criteria = []
+    if boundary is not None:
+        row_key = tuple_(*columns)
+        criteria.append(row_key < boundary if newest_first else row_key > boundary)
+
+    def ordering(sort_columns):
+        return [column.desc() if newest_first else column.asc() for column in sort_columns]
+
+    if union is None:
+        rows = query.filter(*criteria).order_by(*ordering(columns)).limit(per_page + 1).all()
+    else:
+        merged = union_all(*[select(*columns).where(*branch, *criteria) for branch in union])
+        merged = merged.order_by(*ordering(merged.selected_columns)).limit(per_page + 1)
+        ids = [row[-1] for row in query.session.execute(merged)]
+        found = {key(row)[-1]: row for row in query.filter(columns[-1].in_(ids))} if ids else {}
+        rows = [found[row_id] for row_id in ids if row_id in found]
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if not forward:
+        rows.reverse()
+
+    if forward:
+        has_next, has_prev = more, boundary is not None
+    else:
+        has_next, has_prev = True, more
+
+    next_cursor = encode_cursor('next', key(rows[-1]), order) if rows and has_next else None
+    prev_cursor = encode_cursor('prev', key(rows[0]), order) if rows and has_prev else None
+
+    items = [item(row) for row in rows] if item else rows
+    return KeysetPage(items, next_cursor, prev_cursor, total)
@@ -0,0 +1,303 @@
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlparse
+
+from flask import request, session
+from werkzeug.exceptions import TooManyRequests
+
+from cache import redis_client
+
+# Request throttling. A policy decides how many requests a key may make:
+#
+#     TokenBucket(rate, burst)    refills `rate` per second up to `burst`, so
+#                                 short bursts pass but the average is capped
+#     SlidingWindow(limit, window) at most `limit` in any `window` seconds,
+#                                 estimated from this and the previous window
+#
+# and a store keeps the state for every key, selected by RATELIMIT_URL:
+#
+#     memory://?maxsize=100000    in-process, for a single worker process
+#     redis://localhost:6379/0    shared by every worker (needs redis)
+#
+# Both policies keep a few numbers per key, and the Redis store updates them
+# in one atomic script call, so an allowed request costs one lock or one round
+# trip. A store that cannot be reached lets requests through.
+
+RATE_UNITS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_rate(rate):
+    # '20/minute', '5/hour' or '5/900' (seconds) -> (count, seconds)
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+|second|minute|hour|day)s?\s*', rate)
+    if match is None:
+        raise ValueError(f'Invalid rate: {rate!r}')
+    count, period = match.groups()
+    seconds = int(period) if period.isdigit() else RATE_UNITS[period]
+    if not int(count) or not seconds:
+        raise ValueError(f'Invalid rate: {rate!r}')
+    return int(count), seconds
+
+
+class TokenBucket:
+    name = 'token_bucket'
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def from_rate(cls, rate):
+        count, seconds = parse_rate(rate)
+        return cls(count / seconds, count)
+
+    def args(self):
+        return (self.rate, self.burst)
+
+    def new_state(self, now):
+        return [float(self.burst), now]
+
+    def update(self, state, now, cost, consume):
+        # Returns seconds to wait, 0 when `cost` is allowed now
+        tokens = min(self.burst, state[0] + max(0.0, now - state[1]) * self.rate)
+        state[:] = [tokens, now]
+        if tokens >= cost:
+            if consume:
+                state[0] = tokens - cost
+            return 0
+        return (cost - tokens) / self.rate
+
+
+class SlidingWindow:
+    name = 'sliding_window'
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+
+    @classmethod
+    def from_rate(cls, rate):
+        return cls(*parse_rate(rate))
+
+    def args(self):
+        return (self.limit, self.window)
+
+    def new_state(self, now):
+        return [int(now // self.window), 0, 0]
+
+    def update(self, state, now, cost, consume):
+        # state is [window index, previous window's count, this window's]
+        index = int(now // self.window)
+        if state[0] != index:
+            state[:] = [index, state[2] if state[0] == index - 1 else 0, 0]
+        elapsed = now / self.window - index
+        previous, current = state[1], state[2]
+        if previous * (1 - elapsed) + current + cost <= self.limit:
+            if consume:
+                state[2] = current + cost
+            return 0
+        if cost > self.limit:
+            return self.window
+        if current + cost <= self.limit:
+            # Wait for the previous window's weight to fall far enough
+            return (1 - (self.limit - current - cost) / previous - elapsed) * self.window
+        # Wait for the next window, where this one's count is the decaying one
+        return (2 - elapsed - (self.limit - cost) / current) * self.window
+
+
+class MemoryStore:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _update(self, key, policy, cost, consume):
+        now = time.monotonic()
+        key = (key, policy.name)
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                state = self._states[key] = policy.new_state(now)
+                # Dropping the least recently used key only forgets its
+                # history early
+                while len(self._states) > self.maxsize:
+                    self._states.popitem(last=False)
+            else:
+                self._states.move_to_end(key)
+            return policy.update(state, now, cost, consume)
+
+    def acquire(self, key, policy, cost=1):
+        return self._update(key, policy, cost, True)
+
+    def peek(self, key, policy, cost=1):
+        return self._update(key, policy, cost, False)
+
+    def reset(self, key):
+        with self._lock:
+            for name in (TokenBucket.name, SlidingWindow.name):
+                self._states.pop((key, name), None)
+
+
+# The Redis scripts mirror the update() methods above, using the server's
+# clock so workers on different hosts agree
+TOKEN_BUCKET_SCRIPT = '''
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost, consume = tonumber(ARGV[3]), ARGV[4] == '1'
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost then
+    if consume then tokens = tokens - cost end
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+'''
+
+SLIDING_WINDOW_SCRIPT = '''
+local limit, window = tonumber(ARGV[1]), tonumber(ARGV[2])
+local cost, consume = tonumber(ARGV[3]), ARGV[4] == '1'
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local index = math.floor(now / window)
+local state = redis.call('HMGET', KEYS[1], 'index', 'previous', 'current')
+local previous, current = 0, 0
+if tonumber(state[1]) == index then
+    previous, current = tonumber(state[2]), tonumber(state[3])
+elseif tonumber(state[1]) == index - 1 then
+    previous = tonumber(state[3])
+end
+local elapsed = now / window - index
+local wait = 0
+if previous * (1 - elapsed) + current + cost <= limit then
+    if consume then current = current + cost end
+elseif cost > limit then
+    wait = window
+elseif current + cost <= limit then
+    wait = (1 - (limit - current - cost) / previous - elapsed) * window
+else
+    wait = (2 - elapsed - (limit - cost) / current) * window
+end
+redis.call('HSET', KEYS[1], 'index', index, 'previous', previous, 'current', current)
+redis.call('EXPIRE', KEYS[1], 2 * window)
+return tostring(wait)
+'''
+
+
+class RedisStore:
+    def __init__(self, client, prefix='marketplace:ratelimit:', log=print):
+        self.client = client
+        self.prefix = prefix
+        self.log = log
+        self._scripts = {
+            TokenBucket.name: client.register_script(TOKEN_BUCKET_SCRIPT),
+            SlidingWindow.name: client.register_script(SLIDING_WINDOW_SCRIPT),
+        }
+
+    def _update(self, key, policy, cost, consume):
+        try:
+            wait = self._scripts[policy.name](
+                keys=[f'{self.prefix}{policy.name}:{key}'],
+                args=[*policy.args(), cost, int(consume)]
+            )
+        except Exception as e:
+            self.log(f'Rate limit store unavailable, allowing request: {e}')
+            return 0
+        return float(wait)
+
+    def acquire(self, key, policy, cost=1):
+        return self._update(key, policy, cost, True)
+
+    def peek(self, key, policy, cost=1):
+        return self._update(key, policy, cost, False)
+
+    def reset(self, key):
+        try:
+            self.client.delete(*(f'{self.prefix}{name}:{key}' for name in (TokenBucket.name, SlidingWindow.name)))
+        except Exception as e:
+            self.log(f'Rate limit store unavailable: {e}')
+
+
+def create_store(url='memory://', log=print):
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        options = dict(pair.split('=', 1) for pair in parsed.query.split('&') if '=' in pair)
+        return MemoryStore(int(options.get('maxsize', 100000)))
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisStore(redis_client(url), log=log)
+    raise ValueError(f'Unsupported rate limit store URL: {url}')
+
+
+POLICIES = {TokenBucket.name: TokenBucket, SlidingWindow.name: SlidingWindow}
+
+
+def client_address():
+    return request.remote_addr or 'unknown'
+
+
+def user_or_address():
+    # Logged-in users are limited per account, everyone else per address
+    user_id = session.get('user_id')
+    return f'user:{user_id}' if user_id is not None else f'ip:{client_address()}'
+
+
+KEY_FUNCTIONS = {
+    'ip': lambda: f'ip:{client_address()}',
+    'user': user_or_address,
+}
+
+
+class RateLimiter:
+    def __init__(self, store, enabled=True):
+        self.store = store
+        self.enabled = enabled
+
+    def limit(self, rate, by='ip', algorithm=TokenBucket.name, methods=None, scope=None):
+        # Decorator allowing `rate` (e.g. '20/minute') per client of a route.
+        # `by` is 'ip' or 'user'; limits of different routes are separate
+        # unless they share a `scope`. Works for coroutine views too.
+        policy = POLICIES[algorithm].from_rate(rate)
+        key_function = KEY_FUNCTIONS[by]
+
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if self.enabled and (methods is None or request.method in methods):
+                    wait = self.store.acquire(f'{scope or request.endpoint}:{key_function()}', policy)
+                    if wait:
+                        raise TooManyRequests(retry_after=math.ceil(wait))
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+
+
+class LoginThrottle:
+    # Counts failed logins per identifier and per client address, and is
+    # consulted before any password hash is checked, so a flood of guesses
+    # costs a store lookup rather than a KDF run. With a shared store the
+    # counts hold across every worker.
+
+    def __init__(self, store, identifier_limit=5, ip_limit=20, window=900):
+        self.store = store
+        self.identifiers = SlidingWindow(identifier_limit, window)
+        self.addresses = SlidingWindow(ip_limit, window)
+
+    def retry_after(self, identifier, address):
+        return max(self.store.peek(f'login-failures:id:{identifier}', self.identifiers),
+                   self.store.peek(f'login-failures:ip:{address}', self.addresses))
+
+    def failed(self, identifier, address):
+        self.store.acquire(f'login-failures:id:{identifier}', self.identifiers)
+        self.store.acquire(f'login-failures:ip:{address}', self.addresses)
+
+    def succeeded(self, identifier):
+        self.store.reset(f'login-failures:id:{identifier}')
@@ -0,0 +1,169 @@
+import asyncio
+import json
+import queue
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from cache import redis_client
+
+# Publish/subscribe fan-out for pushing new chat messages to open browsers.
+# Selected by BROKER_URL:
+#
+#     memory://                  in-process, for a single worker
+#     redis://localhost:6379/0   Redis pub/sub, for several workers or nodes
+#
+# Subscribers get a bounded queue; a client that stops reading loses
+# messages rather than growing the worker's memory, and catches up from the
+# database when it reconnects. Subscribing with an event loop (as the ASGI
+# views in asgi.py do) gives a subscription to await instead of block on.
+
+
+def conversation_channel(product_id, buyer_id):
+    return f'chat:{product_id}:{buyer_id}'
+
+
+class Subscription:
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except queue.Full:
+            pass
+
+    def get(self, timeout=None):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class AsyncSubscription(Subscription):
+    # put() may be called from any thread, get() only on the loop
+    def __init__(self, broker, channel, loop, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self.loop = loop
+        self._queue = asyncio.Queue(maxsize=maxsize)
+
+    def _put(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            pass
+
+    def put(self, message):
+        try:
+            self.loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The loop has closed; the subscriber is gone
+            pass
+
+    async def get(self, timeout=None):
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, loop=None):
+        if loop is None:
+            subscription = Subscription(self, channel)
+        else:
+            subscription = AsyncSubscription(self, channel, loop)
+        with self._lock:
+            self._subscriptions[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[subscription.channel]
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscriptions.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._subscriptions.get(channel, ()))
+            return sum(len(subscribers) for subscribers in self._subscriptions.values())
+
+
+class RedisBroker:
+    # Every worker holds one pattern subscription to Redis and fans incoming
+    # messages out to its own local subscribers, so the number of Redis
+    # connections does not grow with the number of open chats.
+
+    def __init__(self, client, prefix='marketplace:'):
+        self.client = client
+        self.prefix = prefix
+        self.local = InProcessBroker()
+        self._listener = None
+        self._lock = threading.Lock()
+
+    def _listen(self):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.psubscribe(self.prefix + '*')
+        for event in pubsub.listen():
+            channel = event['channel']
+            if isinstance(channel, bytes):
+                channel = channel.decode()
+            self.local.publish(channel[len(self.prefix):], json.loads(event['data']))
+
+    def _ensure_listener(self):
+        with self._lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name='redis-broker', daemon=True)
+                self._listener.start()
+
+    def subscribe(self, channel, loop=None):
+        self._ensure_listener()
+        return self.local.subscribe(channel, loop)
+
+    def unsubscribe(self, subscription):
+        self.local.unsubscribe(subscription)
+
+    def publish(self, channel, message):
+        self.client.publish(self.prefix + channel, json.dumps(message))
+
+    def subscriber_count(self, channel=None):
+        return self.local.subscriber_count(channel)
+
+
+def create_broker(url='memory://'):
+    scheme = urlparse(url).scheme
+    if scheme == 'memory':
+        return InProcessBroker()
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBroker(redis_client(url))
+    raise ValueError(f'Unsupported broker URL: {url}')
+
+
+def format_event(message, event='message'):
+    return f'id: {message["id"]}\nevent: {event}\ndata: {json.dumps(message)}\n\n'
@@ -0,0 +1,163 @@
+import re
+
+from sqlalchemy import Float, Integer, text
+
+# Product search backends. The FTS5 backend keeps an external-content index
+# over product title/description/category in sync through SQLite triggers, so
+# every insert, update or delete on `product` is reflected without any
+# application code. The LIKE backend is the fallback for databases without
+# FTS5 (or for other dialects) and matches the old behaviour.
+
+TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+MAX_TERMS = 8
+
+
+def tokenize(search):
+    return [term.lower() for term in TOKEN_PATTERN.findall(search)][:MAX_TERMS]
+
+
+class LikeSearchBackend:
+    name = 'like'
+
+    def ensure_schema(self, connection):
+        pass
+
+    def drop_schema(self, connection):
+        pass
+
+    def rebuild(self, connection):
+        pass
+
+    def apply(self, query, model, search):
+        for term in tokenize(search):
+            query = query.filter(model.title.contains(term) | model.description.contains(term))
+        return query, None
+
+
+class FTS5SearchBackend:
+    name = 'fts5'
+    table = 'product_fts'
+    # Column weights for bm25(): title, description, category
+    weights = (10.0, 1.0, 4.0)
+
+    triggers = {
+        'product_fts_ai': '''
+            CREATE TRIGGER product_fts_ai AFTER INSERT ON product BEGIN
+                INSERT INTO product_fts(rowid, title, description, category)
+                VALUES (new.id, new.title, new.description, new.category);
+            END''',
+        'product_fts_ad': '''
+            CREATE TRIGGER product_fts_ad AFTER DELETE ON product BEGIN
+                INSERT INTO product_fts(product_fts, rowid, title, description, category)
+                VALUES ('delete', old.id, old.title, old.description, old.category);
+            END''',
+        'product_fts_au': '''
+            CREATE TRIGGER product_fts_au AFTER UPDATE OF title, description, category ON product BEGIN
+                INSERT INTO product_fts(product_fts, rowid, title, description, category)
+                VALUES ('delete', old.id, old.title, old.description, old.category);
+                INSERT INTO product_fts(rowid, title, description, category)
+                VALUES (new.id, new.title, new.description, new.category);
+            END''',
+    }
+
+    def _existing(self, connection, kind):
+        rows = connection.execute(
+            text('SELECT name FROM sqlite_master WHERE type = :kind'), {'kind': kind}
+        )
+        return {row[0] for row in rows}
+
+    def ensure_schema(self, connection):
+        needs_rebuild = False
+        if self.table not in self._existing(connection, 'table'):
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {self.table} USING fts5("
+                "title, description, category, "
+                "content='product', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            ))
+            needs_rebuild = True
+
+        # Triggers live on the product table, so a drop_all()/create_all()
+        # cycle removes them and leaves the index stale until rebuilt.
+        existing_triggers = self._existing(connection, 'trigger')
+        for name, ddl in self.triggers.items():
+            if name not in existing_triggers:
+                connection.execute(text(ddl))
+                needs_rebuild = True
+
+        if needs_rebuild:
+            self.rebuild(connection)
+
+    def drop_schema(self, connection):
+        for name in self.triggers:
+            connection.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+        connection.execute(text(f'DROP TABLE IF EXISTS {self.table}'))
+
+    def rebuild(self, connection):
+        connection.execute(text(f"INSERT INTO {self.table}({self.table}) VALUES ('rebuild')"))
+
+    def match_expression(self, terms):
+        # Every term must match, each as a prefix so "calc" finds "calculus"
+        return ' '.join(f'"{term}"*' for term in terms)
+
+    def apply(self, query, model, search):
+        terms = tokenize(search)
+        if not terms:
+            return query, None
+
+        weights = ', '.join(str(weight) for weight in self.weights)
+        ranked = text(
+            f'SELECT rowid AS product_id, bm25({self.table}, {weights}) AS rank '
+            f'FROM {self.table} WHERE {self.table} MATCH :match'
+        ).bindparams(match=self.match_expression(terms)).columns(
+            product_id=Integer, rank=Float
+        ).subquery('search_results')
+
+        query = query.join(ranked, ranked.c.product_id == model.id)
+        return query, ranked.c.rank
+
+
+BACKENDS = {
+    'like': LikeSearchBackend,
+    'fts5': FTS5SearchBackend,
+}
+
+
+def fts5_available(engine):
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as connection:
+        return bool(connection.execute(
+            text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        ).scalar())
+
+
+class SearchIndex:
+    def __init__(self, db, backend='auto'):
+        self.db = db
+        self.backend_name = backend
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            name = self.backend_name
+            if name == 'auto':
+                name = 'fts5' if fts5_available(self.db.engine) else 'like'
+            self._backend = BACKENDS[name]()
+        return self._backend
+
+    def ensure_schema(self):
+        with self.db.engine.begin() as connection:
+            self.backend.ensure_schema(connection)
+
+    def drop_schema(self):
+        with self.db.engine.begin() as connection:
+            self.backend.drop_schema(connection)
+
+    def rebuild(self):
+        with self.db.engine.begin() as connection:
+            self.backend.rebuild(connection)
+
+    def apply(self, query, model, search):
+        return self.backend.apply(query, model, search)
@@ -1,11 +1,13 @@
-from app import app, db, User, Product
-from werkzeug.security import generate_password_hash
+from app import app, db, init_db, reset_db, password_hasher, User, Product
 
 def seed_database():
     with app.app_context():
         # Clear existing data
-        db.drop_all()
-        db.create_all()
+        reset_db()
+        init_db()
+        
+        # Hash the test passwords in parallel across the hashing pool
+        hashes = iter(password_hasher.hash_many(['password123'] * 4))
         
         # Create test users
         users = [
@@ -13,23 +15,23 @@ def seed_database():
                 name='John Doe',
                 email='john@sampleschool.edu',
                 reg_number='H200001A',
-                password_hash=generate_password_hash('password123')
+                password_hash=next(hashes)
             ),
             User(
                 name='Jane Smith',
                 email='jane@sampleschool.edu',
                 reg_number='H200002B',
-                password_hash=generate_password_hash('password123')
+                password_hash=next(hashes)
             ),
             User(
                 name='Mike Johnson',
                 reg_number='H200003C',
-                password_hash=generate_password_hash('password123')
+                password_hash=next(hashes)
             ),
             User(
                 name='Sarah Wilson',
                 email='sarah@sampleschool.edu',
-                password_hash=generate_password_hash('password123')
+                password_hash=next(hashes)
             )
         ]
         